@@ -4,7 +4,7 @@ import logging
 from random import randint
 from multiprocessing import shared_memory
 from valkka.multiprocess import MessageProcess, MessageObject, \
-    MainContext, safe_select
+    MainContext, safe_select, stopProcesses
 
 """<rtf>
 First define the worker process that will do some calculation on a shared numpy array.
@@ -133,15 +133,14 @@ class Manager(MainContext):
         pass # no threads in this app
 
     """<rtf>
-    ``close`` (mandatory) stops all multiprocesses and threads in parallel:
+    ``close`` (mandatory) stops all multiprocesses and threads in parallel.  ``stopProcesses``
+    waits for them at most ``timeout`` seconds: any hung multiprocess is terminated:
     <rtf>"""
     def close(self):
         self.logger.debug("close: stopping processes")
-        for p in self.cache:
-            p.requestStop()
-        for p in self.cache:
-            p.waitStop()
-        self.logger.debug("close: processes stopped")
+        report = stopProcesses(self.cache, timeout = 10.0)
+        self.logger.debug("close: processes stopped. Terminated: %s, killed: %s",
+            report["terminated"], report["killed"])
         self.closed = True
 
     """<rtf>
@@ -1,4 +1,8 @@
 from valkka.multiprocess.base import *
 from valkka.multiprocess.sync import *
+from valkka.multiprocess.pool import MessageProcessPool
+from valkka.multiprocess.shmem import SharedArray, SlabPool, SlabBlock
+from valkka.multiprocess.mailbox import FrameMailbox
+from valkka.multiprocess.bus import BroadcastBus, BusReader
 from valkka.multiprocess.version import getVersionTag
 __version__ = getVersionTag()
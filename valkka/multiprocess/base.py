@@ -24,13 +24,27 @@ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEAL
 @brief   A simple multiprocessing framework with back- and frontend and pipes communicating between them
 """
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+from multiprocessing.reduction import DupFd
+from concurrent.futures import Future, InvalidStateError
+import threading
+import itertools
+import queue
 import select
+import selectors
 import errno
 import time
 import sys, signal, os, pickle, math
+import struct
+import socket
+import fcntl
 import logging
 import asyncio
 import traceback
+from collections import deque
+from valkka.multiprocess.ring import RingDuplex, getRingPipes
+from valkka.multiprocess.shmem import arraysToShmem, arraysFromShmem
+from valkka.multiprocess.codec import PickleCodec, BinaryCodec
 
 # from valkka.api2.tools import getLogger, setLogger
 
@@ -39,19 +53,150 @@ logger = logging.getLogger(__name__)
 
 def safe_select(l1, l2, l3, timeout = None):
     """Like select.select, but ignores EINTR
+
+    Uses ``poll`` instead of ``select`` under the hood, so it works also with file descriptors
+    above ``FD_SETSIZE`` (1024).  If you are listening many file descriptors over and over again,
+    consider using ``ProcessSelector`` instead.
+
+    Like ``select.select``, raises ``ValueError`` for a negative timeout and ``OSError`` (EBADF) for a closed file descriptor.
     """
+    if timeout is not None and timeout < 0:
+        raise ValueError("timeout must be non-negative")
+    masks = {} # fd => poll mask
+    objs = {} # fd => list of (object, index of the list)
+    for i, (lis, mask) in enumerate(((l1, select.POLLIN), (l2, select.POLLOUT), (l3, select.POLLPRI))):
+        for obj in lis:
+            fd = obj if isinstance(obj, int) else obj.fileno()
+            masks[fd] = masks.get(fd, 0) | mask
+            objs.setdefault(fd, []).append((obj, i))
+    poller = select.poll()
+    for fd, mask in masks.items():
+        poller.register(fd, mask)
     try:
         if timeout is None:
-            res = select.select(l1, l2, l3) # blocks
+            events = poller.poll() # blocks
         else:
-            res = select.select(l1, l2, l3, timeout) # timeout 0 is just a poll
+            events = poller.poll(timeout*1000) # timeout 0 is just a poll
     except (OSError, select.error) as e:
         if e.errno != errno.EINTR:
             raise
         else: # EINTR doesn't matter
             return [[], [], []]  # dont read socket
-    else:
-        return res  # read socket
+    res = [[], [], []]
+    ready = (
+        select.POLLIN | select.POLLHUP | select.POLLERR, # like select.select
+        select.POLLOUT | select.POLLERR,
+        select.POLLPRI
+    )
+    for fd, event in events:
+        if event & select.POLLNVAL: # select.select fails with a closed fd, instead of returning it forever
+            raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+        for obj, i in objs[fd]:
+            if event & ready[i]:
+                res[i].append(obj)
+    return res  # read socket
+
+
+class ProcessSelector:
+    """Listen simultaneously to many ``MessageProcess`` es (and any other file descriptors) in the main process.
+
+    Pipes are registered once and mapped directly to their ``MessageProcess``, so nothing needs to be
+    rebuilt per call.  Uses epoll in linux, so scales to thousands of multiprocesses.
+
+    ::
+
+        selector = ProcessSelector()
+        for p in processes:
+            selector.register(p)
+        selector.register(some_socket, data = "socket")
+        while True:
+            for obj in selector.select(timeout = 1.0):
+                if obj == "socket":
+                    ...
+                else:
+                    msg = obj.getPipe().recv()
+
+    For ``MessageProcess`` es with ``nonblocking_send``, ``select`` also writes the queued messages
+    when the intercom pipes have space again.
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.writing = set() # MessageProcesses that have queued messages
+
+    def __len__(self):
+        return len(self.selector.get_map())
+
+    def register(self, obj, data = None):
+        """Start listening
+
+        :param obj: a ``MessageProcess``, whose ``getPipe()`` is listened, or anything having a ``fileno`` method, or a file descriptor (int)
+        :param data: object returned by ``select`` when ``obj`` is ready.  Default: ``obj`` itself
+        """
+        if data is None:
+            data = obj
+        if isinstance(obj, MessageProcess):
+            obj.send_watchers.append(self)
+            if obj.getSendQueueDepth() > 0:
+                self.watchWrite__(obj)
+            obj = obj.getPipe()
+        self.selector.register(obj, selectors.EVENT_READ, data)
+
+    def unregister(self, obj):
+        """Stop listening
+
+        :param obj: as given to ``register``
+        """
+        if isinstance(obj, MessageProcess):
+            if self in obj.send_watchers:
+                obj.send_watchers.remove(self)
+            if obj in self.writing:
+                self.writing.discard(obj)
+                self.selector.unregister(obj.send_queue)
+            obj = obj.getPipe()
+        self.selector.unregister(obj)
+
+    def watchWrite__(self, p):
+        """Listen the intercom pipe of ``MessageProcess`` p for writing, until its queued messages have been written
+        """
+        if p not in self.writing:
+            self.writing.add(p)
+            self.selector.register(p.send_queue, selectors.EVENT_WRITE, WriteInterest(p))
+
+    def select(self, timeout = None) -> list:
+        """Wait until some of the registered objects are ready for reading
+
+        :param timeout: timeout in seconds.  ``None`` blocks, ``0`` is just a poll
+
+        Returns a list of the ``data`` objects (given in ``register``) that are ready.  Ignores EINTR
+        """
+        try:
+            events = self.selector.select(timeout)
+        except InterruptedError:
+            return []
+        if not self.writing:
+            return [key.data for key, mask in events]
+        ready = []
+        for key, mask in events:
+            if key.data.__class__ is WriteInterest:
+                p = key.data.process
+                if p.flushSendQueue():
+                    self.writing.discard(p)
+                    self.selector.unregister(p.send_queue)
+            else:
+                ready.append(key.data)
+        return ready
+
+    def close(self):
+        self.selector.close()
+
+
+class WriteInterest:
+    """``ProcessSelector`` data for an intercom pipe that has queued messages
+    """
+    __slots__ = ("process",)
+
+    def __init__(self, process):
+        self.process = process
 
 
 class MessageObject:
@@ -63,6 +208,8 @@ class MessageObject:
     :param command: the command
     :param kwargs: kwargs
 
+    ``call_id`` is set by ``MessageProcess.call``: the backend then returns the result of the ``c__`` method to the frontend.
+
     Example:
 
     ::
@@ -72,9 +219,12 @@ class MessageObject:
         msg["par1"] # returns 1
 
     """
+    __slots__ = ("command", "kwargs", "call_id")
+
     def __init__(self, command, **kwargs):
         self.command = command
         self.kwargs = kwargs
+        self.call_id = None
 
     def __str__(self):
         return "<MessageObject: %s: %s>" % (self.command, self.kwargs)
@@ -86,6 +236,24 @@ class MessageObject:
         return self.kwargs[key]
 
 
+class CallResult:
+    """Return value or exception of a backend ``c__`` method, sent to the frontend for ``MessageProcess.call``
+
+    :param call_id: correlation id of the call
+    :param value: return value
+    :param exception: exception raised by the method, or ``None``
+    """
+    __slots__ = ("call_id", "value", "exception")
+
+    def __init__(self, call_id, value = None, exception = None):
+        self.call_id = call_id
+        self.value = value
+        self.exception = exception
+
+    def __str__(self):
+        return "<CallResult: %s: %s: %s>" % (self.call_id, self.value, self.exception)
+
+
 class MessageProcess(Process):
     """Encapsulates:
 
@@ -97,21 +265,67 @@ class MessageProcess(Process):
     When you send a ``MessageObject`` with command ``myStuff``, the forked multiprocess
     (aka backend) tries to find and execute the method ``c__myStuff`` in the backend.
 
+    Numpy arrays in ``MessageObject`` kwargs that are larger than ``shmem_threshold`` bytes are
+    not pickled through the intercom pipe: they are copied into a shared memory segment and
+    ``c__myStuff`` receives a numpy array that uses that shared memory directly.  Set
+    ``shmem_threshold`` to ``None`` to disable this.
+
     :param name: name of the multiprocess
+    :param ring_size: if not ``None``, use a shared memory ring buffer of this size (in bytes, for each direction)
+                      as the intercom channel instead of ``multiprocessing.Pipe``.  Default: ``None``.
+    :param pipe_capacity: if not ``None``, kernel buffer size (in bytes, for each direction) of the intercom ``multiprocessing.Pipe``.
+                          Larger messages are then written with fewer partial writes and wakeups.  See ``getPipeCapacity`` for
+                          what was granted.  Default: ``None`` (the system default).
+
+    ``c__`` methods are collected into a dispatch table when the process is created and again after ``preRun__``.  If you set ``use_opcodes`` to ``True``,
+    small integers are sent to the backend instead of the command strings.
+
+    Messages to the backend are encoded with ``codec``.  The default ``BinaryCodec`` has a compact binary
+    format for ``MessageObject`` s having str, int, float, bytes, etc. kwargs and pickles everything else.
+    Set ``codec`` to ``PickleCodec()`` to always pickle.
+
+    If you need to listen to other file descriptors (sockets, eventfds, etc.) in the backend, register them with ``registerFd__``:
+    the backend's main loop waits for all of them with a single epoll call, without any busy-polling.
+
+    ``call`` sends a message and returns a ``concurrent.futures.Future`` that gets the return value (or the exception)
+    of the ``c__`` method, so you can have many calls in flight at the same time.
+
+    If ``nonblocking_send`` is ``True``, ``sendMessageToBack`` never blocks: what doesn't fit into the intercom pipe is queued in the
+    frontend (see ``SendQueue``) and written when the pipe has space again.  ``ProcessSelector`` does that automatically.  Set it before
+    starting the process: the backend then reassembles partly written messages without blocking (see ``readBackStream__``).
 
     NOTE: when subclassing ``__init__``, remember to call therein ``super().__init__()``
     """
     timeout = 1.0
+    shmem_threshold = 65536 # numpy arrays larger than this (in bytes) are passed via shared memory
+    use_opcodes = False # send integer opcodes instead of command strings to the backend
+    nonblocking_send = False # queue the messages to the backend in the frontend when the intercom pipe is full
+    codec = BinaryCodec(MessageObject) # encodes the messages sent to the backend
 
-    def __init__(self, name = "MessageProcess"):
+    def __init__(self, name = "MessageProcess", ring_size = None, pipe_capacity = None):
         self.name = name
         self.pre = self.__class__.__name__ + "." + self.name
         self.logger = logging.getLogger(self.pre)
         super().__init__()
-        self.front_pipe, self.back_pipe = Pipe() # incoming messages & pipe that is read by the main pythn process
+        if ring_size is None:
+            self.front_pipe, self.back_pipe = Pipe() # incoming messages & pipe that is read by the main pythn process
+            if pipe_capacity is not None:
+                setSocketBuffers(self.front_pipe, pipe_capacity)
+                setSocketBuffers(self.back_pipe, pipe_capacity)
+        else:
+            # shared memory ring buffers: a file descriptor is used only to wake up an idle reader
+            self.front_pipe, self.back_pipe = getRingPipes(ring_size)
         self.front_pipe_internal, self.back_pipe_internal = Pipe() # used internally, for example, to wait results from the backend
+        self.bindDispatchTable__()
+        self.futures = {} # call_id => Future of the calls in flight
+        self.call_ids = itertools.count()
+        self.call_thread = None # reads the results of the calls
+        self.call_lock = threading.Lock()
+        self.return_queue = queue.Queue() # returnFromBack objects, while call_thread is reading the internal pipe
+        self.send_queue = None # created at the first send, if nonblocking_send is set
+        self.send_watchers = [] # ProcessSelectors that flush send_queue
         self.loop = True
-        self.listening = False # are we listening something else than just the intercom pipes?
+        self.listening = False # are we listening something else than just the intercom pipes?  If True, readPipes__ is busy-polled: prefer registerFd__ instead
         self.sigint = True
 
     @classmethod
@@ -133,6 +347,52 @@ class MessageProcess(Process):
             logger.setLevel(level)
 
 
+    def __getstate__(self):
+        """When started with a fork server (see ``Zygote``), the process is pickled: leave out the frontend-only state
+        """
+        state = self.__dict__.copy()
+        for key in ("dispatch_table", "opcodes", "futures", "call_ids", "call_thread", "call_lock", "return_queue", "send_queue", "send_watchers", "_Popen"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bindDispatchTable__()
+        self.futures = {}
+        self.call_ids = itertools.count()
+        self.call_thread = None
+        self.call_lock = threading.Lock()
+        self.return_queue = queue.Queue()
+        self.send_queue = None
+        self.send_watchers = []
+
+    @classmethod
+    def getOpcodes(cls) -> dict:
+        """Returns a dictionary that maps the command names of the ``c__`` methods to integer opcodes, created once per class.
+
+        Opcodes are the indexes of the alphabetically sorted command names, so
+        they are the same at both sides of the fork.
+        """
+        if "opcodes__" not in cls.__dict__: # not inherited from a parent class
+            names = sorted(name[3:] for name in dir(cls) if name.startswith("c__"))
+            cls.opcodes__ = {name: opcode for opcode, name in enumerate(names)}
+        return cls.opcodes__
+
+    def bindDispatchTable__(self):
+        """Maps both command names and integer opcodes to the bound ``c__`` methods.
+
+        Binding is done with ``getattr``, so static and class methods, as well as ``c__`` methods set to the instance
+        (in ``__init__`` or ``preRun__``) work as usual.  ``c__`` methods set to the instance later on are found only if the class
+        doesn't have a method with the same name
+        """
+        self.opcodes = self.getOpcodes()
+        self.dispatch_table = {}
+        for name, opcode in self.opcodes.items():
+            method = getattr(self, "c__" + name)
+            if callable(method):
+                self.dispatch_table[name] = method
+                self.dispatch_table[opcode] = method
+
     def __str__(self):
         return "<"+self.pre+">"
 
@@ -167,7 +427,19 @@ class MessageProcess(Process):
         """
         if self.sigint == False:
             signal.signal(signal.SIGINT, signal.SIG_IGN) # handle in master process correctly
+        if isinstance(self.back_pipe, RingDuplex):
+            # both sides have the shmem mapped now: no need for the names anymore
+            self.back_pipe.unlink()
+        self.selector__ = selectors.DefaultSelector() # epoll in linux
+        if self.nonblocking_send and not isinstance(self.back_pipe, RingDuplex):
+            # the frontend may have written only a part of a frame: read what there is, never wait for the rest
+            self.back_socket__ = socket.socket(fileno = os.dup(self.back_pipe.fileno()))
+            self.back_frames__ = ConnectionFrameReader(self.codec)
+            self.registerFd__(self.back_socket__, self.readBackStream__)
+        else:
+            self.registerFd__(self.back_pipe, self.drainBackPipe__, self.back_pipe)
         self.preRun__()
+        self.bindDispatchTable__() # see the c__ methods set to the instance in preRun__
         while self.loop:
             if self.listening:
                 self.readPipes__(timeout = 0) # timeout = 0 == just poll
@@ -179,32 +451,94 @@ class MessageProcess(Process):
         self.postRun__()
 
 
+    def registerFd__(self, fd, callback, *args):
+        """Multiprocessing backend method: start listening a file descriptor in the backend's main loop.
+        Call this in ``preRun__`` or in any of the ``c__`` methods.
+
+        :param fd: a file descriptor (int) or an object having the ``fileno`` method, say, a socket, a pipe or an ``EventFd``
+        :param callback: called as ``callback(*args)`` when ``fd`` is ready for reading
+
+        Much like ``loop.add_reader`` in asyncio.  No need to subclass ``readPipes__`` or to use busy-polling (``self.listening``).
+        """
+        self.selector__.register(fd, selectors.EVENT_READ, (callback, args))
+
+    def unregisterFd__(self, fd):
+        """Multiprocessing backend method: stop listening a file descriptor
+
+        :param fd: a file descriptor or an object, as given to ``registerFd__``
+        """
+        self.selector__.unregister(fd)
+
     def readPipes__(self, timeout):
-        """Multiprocessing backend method: listen simultaneously (i.e. "multiplex") all intercom pipes.
+        """Multiprocessing backend method: listen simultaneously (i.e. "multiplex") all intercom pipes
+        and the file descriptors registered with ``registerFd__``.
 
-        If you need to listen additionally anything else than the normal intercom pipe, please subclass this one.
+        If you need to listen additionally anything else than the normal intercom pipe, use ``registerFd__``,
+        or subclass this one.
 
         :param timeout: listening i/o timeout in seconds
         """
-        rlis = [self.back_pipe]
-        r, w, e = safe_select(rlis, [], [], timeout = timeout) # timeout = 0 == this is just a poll
-        # handle the main intercom pipe
-        if self.back_pipe in r:
-            self.handleBackPipe__(self.back_pipe)    
-            r.remove(self.back_pipe)
-        # in your subclass, handle rest of the pipes
+        fd_map = self.selector__.get_map()
+        for key, mask in self.selector__.select(timeout):
+            if fd_map.get(key.fd) is not key: # unregistered (and maybe closed) by a previous callback
+                continue
+            callback, args = key.data
+            callback(*args)
 
 
-    def handleBackPipe__(self, p):
-        """Route message to correct method
+    def drainBackPipe__(self, p):
+        """Handle all messages that are in the main intercom pipe before going back to select
+        """
+        while self.handleBackPipe__(p) and self.loop and p.poll():
+            pass
+
+
+    def handleBackPipe__(self, p) -> bool:
+        """Route message (or a list of messages sent with ``sendMessagesToBack``) to correct method.
+
+        Returns ``False`` if reading the pipe failed
         """
         ok = True
         try:
-            obj = p.recv()
+            obj = self.codec.decode(p.recv_bytes())
         except Exception as e:
             self.logger.critical("Reading pipe failed with %s", e)
             ok = False
-        if ok: 
+        if ok:
+            self.routeBackObject__(obj)
+        return ok
+
+
+    def readBackStream__(self):
+        """With ``nonblocking_send``: read what there is in the main intercom pipe and route the complete messages.
+        A partially written message stays in ``back_frames__`` until the frontend has written the rest, so the backend
+        keeps serving the other file descriptors meanwhile
+        """
+        while self.loop:
+            try:
+                data = self.back_socket__.recv(STREAM_CHUNK, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not data:
+                self.logger.critical("Reading pipe failed: frontend has closed the pipe")
+                self.unregisterFd__(self.back_socket__)
+                self.loop = False
+                return
+            for obj in self.back_frames__.feed(data):
+                self.routeBackObject__(obj)
+                if not self.loop:
+                    return
+
+
+    def routeBackObject__(self, obj):
+        """Route a message, or a list of messages sent with ``sendMessagesToBack``
+        """
+        if isinstance(obj, list):
+            for o in obj:
+                self.routeMainPipe__(o)
+                if not self.loop:
+                    break
+        else:
             self.routeMainPipe__(obj)
 
 
@@ -220,16 +554,38 @@ class MessageProcess(Process):
             self.loop = False
             return
 
-        method_name = "c__%s" % (obj.command)
-        if hasattr(self, method_name):
-            method = getattr(self, method_name)
+        method = self.dispatch_table.get(obj.command)
+        if method is None:
+            method = self.getMethod__(obj.command)
+        kwargs = arraysFromShmem(obj.kwargs) # also releases shared memory, if there is no method
+        if method is None:
+            self.logger.warning("routeMainPipe : no such method c__%s" %(obj.command))
+            if obj.call_id is not None:
+                self.returnCall__(CallResult(obj.call_id, exception = AttributeError("no such method c__%s" % (obj.command))))
+            return
+        if obj.call_id is not None:
             try:
-                method(**obj.kwargs)
-            except TypeError:
-                self.logger.warning("routeMainPipe : could not call method %s with parameters %s" % (method_name, obj.kwargs))
-                raise
-        else:
-            self.logger.warning("routeMainPipe : no such method %s" %(method_name))
+                value = method(**kwargs)
+            except Exception as e:
+                self.returnCall__(CallResult(obj.call_id, exception = e))
+            else:
+                self.returnCall__(CallResult(obj.call_id, value = value))
+            return
+        try:
+            method(**kwargs)
+        except TypeError:
+            self.logger.warning("routeMainPipe : could not call method c__%s with parameters %s" % (obj.command, obj.kwargs))
+            raise
+
+
+    def getMethod__(self, command):
+        """Returns the bound ``c__`` method of a command, or ``None`` if there is no such command
+        """
+        method = self.dispatch_table.get(command)
+        if method is not None:
+            return method
+        # not in the class, but maybe set dynamically to the instance
+        return getattr(self, "c__%s" % (command), None)
 
 
     def send_out__(self, obj):
@@ -243,6 +599,16 @@ class MessageProcess(Process):
         self.back_pipe_internal.send(obj)
 
 
+    def returnCall__(self, result):
+        """Multiprocessing backend method: send the result of a ``call`` to the frontend
+        """
+        try:
+            self.return_out__(result)
+        except Exception as e: # the value or the exception could not be pickled
+            self.logger.warning("returnCall__ : could not return %s: %s", result, e)
+            self.return_out__(CallResult(result.call_id, exception = RuntimeError("could not return the result: %s" % (e))))
+
+
     # *** _your_ backend methods ***
 
     def c__ping(self, lis = []):
@@ -262,17 +628,187 @@ class MessageProcess(Process):
     def getPipe(self) -> Pipe:
         """Multiprocessing frontend method: returns the pipe you can use to listen to messages sent by the multiprocessing backend.
 
-        returns a ``multiprocessing.Pipe`` instance
+        returns a ``multiprocessing.Pipe`` instance (or a ``RingDuplex`` instance if ``ring_size`` was used).  Both
+        can be used with ``select.select``
         """
         return self.front_pipe
 
+    def packMessage(self, message: MessageObject) -> MessageObject:
+        """Multiprocessing frontend method: move large numpy arrays of the message into shared memory
+        and replace the command with an integer opcode (if ``use_opcodes`` is set).
+        Returns a new ``MessageObject`` if anything was changed.
+        """
+        if message is None:
+            return message
+        command = message.command
+        if self.use_opcodes:
+            command = self.opcodes.get(command, command)
+        kwargs = message.kwargs
+        if self.shmem_threshold is not None:
+            kwargs = arraysToShmem(kwargs, self.shmem_threshold)
+        if command is message.command and kwargs is message.kwargs:
+            return message
+        new = MessageObject(command, **kwargs)
+        new.call_id = message.call_id
+        return new
+
     def sendMessageToBack(self, message: MessageObject):
         """Multiprocessing frontend method: send a ``MessageObject`` to multiprocessing backend
         """
-        self.front_pipe.send(message)
+        if self.nonblocking_send:
+            self.queueSend__(self.getSendQueue__().frame(self.codec.encode(self.packMessage(message))))
+            return
+        self.front_pipe.send_bytes(self.codec.encode(self.packMessage(message)))
+
+    def sendMessagesToBack(self, messages):
+        """Multiprocessing frontend method: send several ``MessageObject`` s to multiprocessing backend
+        with a single write into the intercom pipe
+
+        :param messages: an iterable of ``MessageObject`` s
+        """
+        if self.nonblocking_send:
+            self.queueSend__(self.getSendQueue__().frame(self.codec.encodeMany([self.packMessage(message) for message in messages])))
+            return
+        self.front_pipe.send_bytes(self.codec.encodeMany([self.packMessage(message) for message in messages]))
+
+    def getSendQueue__(self):
+        """Multiprocessing frontend method: the ``SendQueue`` of the intercom pipe, created at the first call
+        """
+        if self.send_queue is None:
+            self.send_queue = SendQueue(self.front_pipe)
+        return self.send_queue
+
+    def queueSend__(self, buffers):
+        """Multiprocessing frontend method: write a message into the intercom pipe, or queue it if the pipe is full
+        """
+        if not self.getSendQueue__().put(buffers):
+            for selector in self.send_watchers:
+                selector.watchWrite__(self)
+
+    def flushSendQueue(self, timeout = 0) -> bool:
+        """Multiprocessing frontend method: write messages queued with ``nonblocking_send`` into the intercom pipe
+
+        :param timeout: wait at most this many seconds for the pipe to have space.  ``0`` writes only what fits now, ``None`` waits until everything is written
+
+        Returns ``True`` if the queue is empty.  Returns also if the backend exits
+        """
+        if self.send_queue is None:
+            return True
+        if self.send_queue.flush():
+            return True
+        if timeout == 0:
+            return False
+        poller = select.poll()
+        poller.register(self.send_queue.fileno(), select.POLLOUT)
+        try:
+            poller.register(self.sentinel, select.POLLIN)
+        except ValueError: # not started yet
+            pass
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                events = poller.poll(None if deadline is None else max(deadline - time.monotonic(), 0)*1000)
+            except InterruptedError:
+                continue
+            if not events: # timeout
+                return False
+            for fd, mask in events:
+                if fd != self.send_queue.fileno(): # sentinel: backend has exited
+                    return self.send_queue.flush()
+            if self.send_queue.flush():
+                return True
+
+    def getSendQueueDepth(self) -> int:
+        """Multiprocessing frontend method: number of messages queued with ``nonblocking_send``, waiting for space in the intercom pipe
+        """
+        if self.send_queue is None:
+            return 0
+        return self.send_queue.getDepth()
+
+    def call(self, command, **kwargs) -> Future:
+        """Multiprocessing frontend method: send a ``MessageObject`` to the backend and return a ``concurrent.futures.Future``
+        that gets the return value of the backend method ``c__command``.  If the backend method raises an exception,
+        it is set to the future.
+
+        You can have as many calls in flight as you like:
+
+        ::
+
+            futures = [p.call("square", x = i) for i in range(100)]
+            results = [future.result() for future in futures]
+        """
+        message = MessageObject(command, **kwargs)
+        message.call_id = next(self.call_ids)
+        future = Future()
+        self.futures[message.call_id] = future # before sending: the result might come back immediately
+        with self.call_lock:
+            self.startCallThread__()
+        self.sendMessageToBack(message)
+        return future
+
+    def startCallThread__(self):
+        """Multiprocessing frontend method: start the thread that reads the internal pipe, if it's not running.  Call holding ``call_lock``
+        """
+        if self.call_thread is None:
+            self.call_thread = threading.Thread(target = self.readCallResults__, daemon = True)
+            self.call_thread.start()
+
+    def readCallResults__(self):
+        """Multiprocessing frontend method: runs in a thread, started by ``call`` or ``returnFromBack``.  Reads the internal pipe, sets the results of the calls
+        to their futures and passes everything else to ``returnFromBack``.  Exits when the backend has exited.
+        """
+        while True:
+            try:
+                objs = [self.front_pipe_internal, self.sentinel]
+            except ValueError: # not started yet
+                objs = [self.front_pipe_internal]
+            ready = wait(objs, timeout = self.timeout)
+            if self.front_pipe_internal in ready:
+                try:
+                    obj = self.front_pipe_internal.recv()
+                except (EOFError, OSError):
+                    break
+                if obj.__class__ is CallResult:
+                    self.setCallResult__(obj)
+                else:
+                    self.return_queue.put(obj)
+            elif len(ready) > 0: # sentinel: the backend has exited and there is nothing left to read
+                break
+        with self.call_lock:
+            self.call_thread = None
+            for call_id in list(self.futures.keys()):
+                self.setCallResult__(CallResult(call_id, exception = BrokenPipeError("multiprocessing backend has exited")))
+
+    def setCallResult__(self, result):
+        future = self.futures.pop(result.call_id, None)
+        if future is None:
+            return
+        try:
+            if result.exception is None:
+                future.set_result(result.value)
+            else:
+                future.set_exception(result.exception)
+        except InvalidStateError: # cancelled
+            pass
 
     def returnFromBack(self):
-        return self.front_pipe_internal.recv()
+        """Multiprocessing frontend method: wait for an object sent by the backend with ``return_out__``
+
+        The internal pipe is always read by the same thread as the results of ``call`` s, so this can be used together with ``call``
+        from any thread.  Raises ``BrokenPipeError`` if the backend has exited and there is nothing left to read
+        """
+        while True:
+            with self.call_lock:
+                if self.call_thread is None:
+                    if not self.return_queue.empty():
+                        return self.return_queue.get()
+                    if self.exitcode is not None:
+                        raise BrokenPipeError("multiprocessing backend has exited")
+                    self.startCallThread__()
+            try:
+                return self.return_queue.get(timeout = self.timeout)
+            except queue.Empty: # check again, in case the thread has exited
+                pass
 
     def go(self):
         """Multiprocessing frontend method: a synonym to multiprocessing ``start()``
@@ -285,16 +821,49 @@ class MessageProcess(Process):
         self.sendMessageToBack(None)
         
     def waitStop(self):
-        """Multiprocessing frontend method: alias to multiprocessing ``join()``
+        """Multiprocessing frontend method: alias to multiprocessing ``join()``.  Writes first all queued messages (see ``nonblocking_send``)
         """
+        self.flushSendQueue(timeout = None)
         self.join()
 
-    def stop(self):
+    def stop(self, timeout = None):
         """Multiprocessing frontend method: request backend multiprocess to stop and wait until it has finished
+
+        :param timeout: if not ``None``, wait at most this many seconds before terminating the multiprocess (see ``stopProcesses``)
         """
+        if timeout is not None:
+            stopProcesses([self], timeout = timeout)
+            return
         self.requestStop()
         self.waitStop()
 
+    def getPipeCapacity(self) -> dict:
+        """Multiprocessing frontend method: returns a dictionary with keys ``to_back`` and ``to_front``: the kernel buffer sizes (in bytes)
+        of the intercom channel in each direction.  For a ``multiprocessing.Pipe``, these are the ``SO_SNDBUF`` values of the sending sockets
+        and for a ``ring_size`` channel, the ring buffer sizes
+        """
+        if isinstance(self.front_pipe, RingDuplex):
+            return {"to_back": self.front_pipe.tx.size, "to_front": self.front_pipe.rx.size}
+        if isinstance(self.front_pipe, Duplex):
+            return {"to_back": getPipeCapacity(self.front_pipe.getWriteFd()), "to_front": getPipeCapacity(self.front_pipe.getReadFd())}
+        return {"to_back": getSocketBuffer(self.front_pipe), "to_front": getSocketBuffer(self.back_pipe)}
+
+    def isWritable(self) -> bool:
+        """Multiprocessing frontend method: can a (small) message be sent to the backend without blocking?  With ``nonblocking_send``,
+        ``False`` also if there are queued messages
+        """
+        if self.send_queue is not None and self.send_queue.getDepth() > 0:
+            return False
+        if isinstance(self.front_pipe, RingDuplex):
+            return self.front_pipe.tx.free() >= 256
+        if isinstance(self.front_pipe, Duplex):
+            fd = self.front_pipe.getWriteFd()
+        else:
+            fd = self.front_pipe.fileno()
+        poller = select.poll()
+        poller.register(fd, select.POLLOUT)
+        return any(mask & select.POLLOUT for fd_, mask in poller.poll(0))
+
     # *** _your_ frontend methods ***
 
     def sendPing(self, lis):
@@ -318,13 +887,16 @@ class MessageProcess(Process):
 # Mixed sync/async processes
 
 
-def getPipes(block_A = False, block_B = False):
+def getPipes(block_A = False, block_B = False, oob = False, capacity = None):
     """
 
     Either A or B can be blocking or non-blocking 
 
     non-blocking pipe-terminal is required for asyncio
 
+    :param oob: if ``True``, ``Duplex.send`` uses pickle protocol 5 out-of-band buffers (see ``toOOBMessage``)
+    :param capacity: if not ``None``, kernel buffer size of both pipes in bytes (see ``setPipeCapacity``)
+
     ::
 
         A           B
@@ -336,6 +908,9 @@ def getPipes(block_A = False, block_B = False):
     """
     B_read_fd, A_write_fd = os.pipe()
     A_read_fd, B_write_fd = os.pipe()
+    if capacity is not None:
+        setPipeCapacity(A_write_fd, capacity)
+        setPipeCapacity(B_write_fd, capacity)
     #print("read, write pair", B_read_fd, A_write_fd)
     #print("read, write pair", A_read_fd, B_write_fd)
     # these a file descriptors, i.e. numbers
@@ -354,11 +929,287 @@ def getPipes(block_A = False, block_B = False):
         os.set_blocking(B_read_fd, False)
         os.set_blocking(B_write_fd, False)
 
-    return Duplex(A_read_fd, A_write_fd), Duplex(B_read_fd, B_write_fd)
+    return Duplex(A_read_fd, A_write_fd, oob = oob), Duplex(B_read_fd, B_write_fd, oob = oob)
+
+
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031) # linux
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+
+
+def setPipeCapacity(fd, size: int) -> int:
+    """Set the kernel buffer size of a pipe with ``F_SETPIPE_SZ``
+
+    :param fd: either end of the pipe
+    :param size: size in bytes.  The kernel rounds it up to a power of two number of pages.  Without privileges,
+                 the maximum is in ``/proc/sys/fs/pipe-max-size`` (1 MB by default): larger sizes are reduced to that
+
+    Returns the size that was granted.  Does nothing, but returns the current size (or ``None``), if the system has no ``F_SETPIPE_SZ``
+    """
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except PermissionError:
+        with open("/proc/sys/fs/pipe-max-size") as f:
+            size = min(size, int(f.read()))
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        return getPipeCapacity(fd)
+
+
+def getPipeCapacity(fd) -> int:
+    """Returns the kernel buffer size of a pipe in bytes, or ``None`` if the system doesn't tell
+    """
+    try:
+        return fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except OSError:
+        return None
+
+
+def setSocketBuffers(conn, size: int) -> int:
+    """Set the kernel send and receive buffer sizes (``SO_SNDBUF`` and ``SO_RCVBUF``) of a ``multiprocessing.Connection`` socket
+
+    :param conn: a ``multiprocessing.Connection`` (or anything having ``fileno``) using a socket
+    :param size: size in bytes.  The maximum is in ``/proc/sys/net/core/wmem_max`` and ``rmem_max``
+
+    Returns the send buffer size that was granted (linux doubles the value for bookkeeping overhead)
+    """
+    sock = socket.socket(fileno = os.dup(conn.fileno()))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    finally:
+        sock.close()
+
+
+def getSocketBuffer(conn) -> int:
+    """Returns the send buffer size (``SO_SNDBUF``) of a ``multiprocessing.Connection`` socket
+    """
+    sock = socket.socket(fileno = os.dup(conn.fileno()))
+    try:
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    finally:
+        sock.close()
+
+
+OOB_FLAG = 1 << 63 # set in the length header of a frame having pickle protocol 5 out-of-band buffers
+OOB_MIN_SIZE = 4096 # smaller buffers are pickled in-band
+IOV_MAX = 1024 # max number of buffers for a single os.writev
+
+
+def toOOBMessage(obj) -> list:
+    """Pickle obj with protocol 5, keeping large buffers (bytearrays, numpy arrays, etc.) out-of-band.
+
+    Returns a list of buffers that can be written as-is with ``os.writev``: the buffers of ``obj``
+    are not copied.  The frame looks like this:
+
+    ::
+
+        8 bytes: OOB_FLAG | total length of the frame (including these 8 bytes)
+        8 bytes: length of the pickle payload
+        8 bytes: number of out-of-band buffers, n
+        n x 8 bytes: lengths of the out-of-band buffers
+        pickle payload
+        out-of-band buffers
+    """
+    buffers = []
+    def callback(pb):
+        try:
+            raw = pb.raw()
+        except BufferError: # not contiguous
+            return True
+        if raw.nbytes < OOB_MIN_SIZE:
+            return True
+        buffers.append(raw)
+        return False # i.e. out-of-band
+    b = pickle.dumps(obj, protocol = 5, buffer_callback = callback)
+    n_header = 8 + 8 + 8 + 8*len(buffers)
+    total = n_header + len(b) + sum(buf.nbytes for buf in buffers)
+    header = (OOB_FLAG | total).to_bytes(8, byteorder = "big") +\
+        len(b).to_bytes(8, byteorder = "big") +\
+        len(buffers).to_bytes(8, byteorder = "big") +\
+        b"".join(buf.nbytes.to_bytes(8, byteorder = "big") for buf in buffers)
+    return [header, b] + buffers
+
+
+def fromOOBMessage(body):
+    """Unpickle a frame created with ``toOOBMessage``.
+
+    :param body: bytes-like object having the frame, excluding the first 8 bytes
+
+    The out-of-band buffers of the returned object use the memory of ``body`` directly.
+    Use a ``bytearray`` for ``body`` if you want the buffers to be writable.
+    """
+    body = memoryview(body)
+    n_pickle = int.from_bytes(body[0:8], byteorder = "big")
+    n_buffers = int.from_bytes(body[8:16], byteorder = "big")
+    i = 16 + 8*n_buffers
+    payload = body[i:i + n_pickle]
+    i += n_pickle
+    buffers = []
+    for j in range(n_buffers):
+        n = int.from_bytes(body[16 + 8*j:24 + 8*j], byteorder = "big")
+        buffers.append(body[i:i + n])
+        i += n
+    return pickle.loads(payload, buffers = buffers)
+
+
+def writevAll(fd, buffers):
+    """Write a list of buffers into a blocking file descriptor with ``os.writev``
+    """
+    buffers = [memoryview(buf).cast("B") for buf in buffers]
+    while buffers:
+        n = os.writev(fd, buffers[:IOV_MAX])
+        buffers = skipBytes(buffers, n)
+
+
+def skipBytes(buffers, n):
+    """Drop ``n`` first bytes from a list of memoryviews
+    """
+    while n > 0:
+        if n >= buffers[0].nbytes:
+            n -= buffers[0].nbytes
+            buffers = buffers[1:]
+        else:
+            buffers = [buffers[0][n:]] + buffers[1:]
+            n = 0
+    return buffers
+
+
+def writevTransport(transport, fd, buffers):
+    """Write a list of buffers into an asyncio write transport, trying ``os.writev`` first
+
+    If the transport has nothing buffered, write directly to its (non-blocking) file descriptor:
+    what does not fit into the pipe, is handed over to the transport
+    """
+    buffers = [memoryview(buf).cast("B") for buf in buffers]
+    if transport.get_write_buffer_size() == 0:
+        try:
+            n = os.writev(fd, buffers[:IOV_MAX])
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        buffers = skipBytes(buffers, n)
+    for buf in buffers:
+        transport.write(buf)
+
+
+class SendQueue:
+    """A userspace queue for the frontend end of an intercom pipe: writes never block.  What doesn't fit into the pipe is queued and
+    written by ``flush`` once the pipe has space again.
+
+    :param pipe: a ``multiprocessing.Connection`` (from ``multiprocessing.Pipe``) or a ``Duplex``
+
+    Writes through a file descriptor of its own: a duplicate of the ``Connection`` socket, written with ``MSG_DONTWAIT``, or the
+    ``Duplex`` write pipe opened again in non-blocking mode.  So blocking writes through ``pipe`` work as before.
+
+    A frame may be written only partly, the rest being queued: the backend must read the pipe without blocking in the middle of a frame
+    (``MessageProcess.readBackStream__`` and ``FrameProtocol`` do).  ``fileno`` can be registered into a selector for writing.  Don't modify buffers (say, numpy arrays sent with ``oob``) while they are queued.
+    """
+    def __init__(self, pipe):
+        if isinstance(pipe, RingDuplex):
+            raise ValueError("SendQueue: nonblocking_send is not supported with ring_size")
+        self.sock = None
+        if isinstance(pipe, Duplex):
+            # a new open file description, so that O_NONBLOCK doesn't affect the blocking writes through the Duplex
+            self.fd = os.open("/proc/self/fd/%i" % (pipe.getWriteFd()), os.O_WRONLY | os.O_NONBLOCK)
+            self.frame = self.frame8Byte__
+        else:
+            self.sock = socket.socket(fileno = os.dup(pipe.fileno()))
+            self.fd = self.sock.fileno()
+            self.frame = self.frameConnection__
+        self.messages = deque() # lists of memoryviews, one list per message
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def __del__(self):
+        try:
+            if self.sock is not None:
+                self.sock.close()
+            else:
+                os.close(self.fd)
+        except (OSError, AttributeError):
+            pass
+
+    def fileno(self):
+        """The file descriptor that the messages are written to
+        """
+        return self.fd
+
+    def frameConnection__(self, b) -> list:
+        n = len(b)
+        if n > 0x7fffffff:
+            return [struct.pack("!iQ", -1, n), b]
+        return [struct.pack("!i", n), b]
+
+    def frame8Byte__(self, b) -> list:
+        val = len(b) + 8
+        return [val.to_bytes(8, byteorder = "big"), b, bytes(math.ceil(val/8)*8 - val)]
+
+    def writev__(self, buffers) -> int:
+        try:
+            if self.sock is not None:
+                return self.sock.sendmsg(buffers, [], socket.MSG_DONTWAIT)
+            return os.writev(self.fd, buffers)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    def put(self, buffers) -> bool:
+        """Write a message (a list of buffers, i.e. a frame), or queue what doesn't fit.  Returns ``True`` if all of it was written
+        """
+        buffers = [memoryview(buf).cast("B") for buf in buffers]
+        with self.lock:
+            if not self.messages and len(buffers) <= IOV_MAX:
+                n = self.writev__(buffers)
+                buffers = skipBytes(buffers, n)
+                if not buffers:
+                    return True
+            self.messages.append(buffers)
+            self.n_bytes += sum(buf.nbytes for buf in buffers)
+            return self.flush__()
+
+    def flush(self) -> bool:
+        """Write as much of the queue as fits into the pipe.  Returns ``True`` if the queue is empty
+        """
+        with self.lock:
+            return self.flush__()
+
+    def flush__(self) -> bool:
+        while self.messages:
+            buffers = []
+            for message in self.messages:
+                buffers += message
+                if len(buffers) >= IOV_MAX:
+                    break
+            n = self.writev__(buffers[:IOV_MAX])
+            if n == 0:
+                return False
+            self.n_bytes -= n
+            while n > 0: # drop the written bytes
+                message = self.messages[0]
+                size = sum(buf.nbytes for buf in message)
+                if n >= size:
+                    self.messages.popleft()
+                    n -= size
+                else:
+                    self.messages[0] = skipBytes(message, n)
+                    n = 0
+        return True
+
+    def getDepth(self) -> int:
+        """Number of messages (completely or partially) in the queue
+        """
+        return len(self.messages)
+
+    def getBytes(self) -> int:
+        """Number of bytes in the queue
+        """
+        return self.n_bytes
 
 
 def to8ByteMessage(obj):
-    b = pickle.dumps(obj)
+    return to8ByteFrame(pickle.dumps(obj))
+
+
+def to8ByteFrame(b):
     # r, w, e = safe_select([], [self.write_fd], [])
     # print("writing to", self.write_fd)
     val = len(b) + 8 # length of the message, including the first 8 bytes
@@ -371,11 +1222,17 @@ def to8ByteMessage(obj):
 class Duplex:
     """Creates a duplex, similar to what you get from multiprocessing.Pipe(), but other side of the
     duplex is non-blocking (for asyncio backend)
+
+    :param read_fd: file descriptor for reading
+    :param write_fd: file descriptor for writing
+    :param oob: send using pickle protocol 5 out-of-band buffers, so that big payloads are not copied.  Default: ``False``.
+                ``recv`` understands both kinds of frames.
     """
-    def __init__(self, read_fd, write_fd):
+    def __init__(self, read_fd, write_fd, oob = False):
         # file descriptors, i.e. numbers:
         self.read_fd = read_fd
         self.write_fd = write_fd
+        self.oob = oob
         # these are _io.FileIO objects:
         self.reader = os.fdopen(read_fd, "br", buffering = 0)
         self.writer = os.fdopen(write_fd, "bw", buffering = 0)
@@ -401,42 +1258,208 @@ class Duplex:
         """
         return self.writer
 
+    def readinto__(self, mv):
+        """Fill the memoryview from the pipe.  For a big memoryview, this
+        is just a few ``readinto`` calls, each one reading as much as there is in the pipe
+        """
+        i = 0
+        while i < len(mv):
+            n = self.reader.readinto(mv[i:])
+            if not n:
+                raise EOFError("pipe closed")
+            i += n
+
     def recv(self):
         """Traditional blocking recv
         """
-        msg = b''
-        N = None
-        cc = 0
-        while True:
-            # print("waiting stream")
-            res = self.reader.read(8)
-            cc += 8
-            if N is None:
-                # decode the first 8 bytes into int
-                N = int.from_bytes(res, byteorder = "big")
-                # print("N>", N)
-            # print(res, len(res))
-            msg += res
-            if cc >= N:
-                break
-        msg = msg[8:N] # remove any padding bytes
-        obj = pickle.loads(msg)
-        return obj
+        header = bytearray(8)
+        self.readinto__(memoryview(header))
+        N = int.from_bytes(header, byteorder = "big")
+        if N & OOB_FLAG:
+            # pickle protocol 5 frame: read everything into preallocated memory
+            body = bytearray((N & ~OOB_FLAG) - 8)
+            self.readinto__(memoryview(body))
+            return fromOOBMessage(body)
+        # the rest of the frame, including padding, in one go
+        body = bytearray(math.ceil(N/8)*8 - 8)
+        self.readinto__(memoryview(body))
+        return pickle.loads(memoryview(body)[0:N - 8]) # remove any padding bytes
 
     def send(self, obj):
         """Tradition blocking send
         """
+        if self.oob:
+            buffers = toOOBMessage(obj)
+            writevAll(self.write_fd, buffers)
+            return sum(memoryview(buf).nbytes for buf in buffers)
         msg = to8ByteMessage(obj)
         n = self.writer.write(msg)
         # self.writer.flush() # no effect
         # print("wrote", n, "bytes")
         return n
 
+    def send_bytes(self, b):
+        """Blocking send of an already encoded payload (see ``codec.py``) as a frame
+        """
+        return self.writer.write(to8ByteFrame(b))
+
+    def sendManyBytes(self, bs):
+        """Blocking send of several encoded payloads, each one as a frame, with a single write
+        """
+        return self.writer.write(b"".join(to8ByteFrame(b) for b in bs))
+
+    def sendMany(self, objs):
+        """Blocking send of a list of objects with a single write
+        """
+        if self.oob:
+            buffers = []
+            for obj in objs:
+                buffers += toOOBMessage(obj)
+            writevAll(self.write_fd, buffers)
+            return sum(memoryview(buf).nbytes for buf in buffers)
+        return self.writer.write(b"".join(to8ByteMessage(obj) for obj in objs))
+
+    def __reduce__(self):
+        # when the process is started with a fork server (see zygote.py), the file descriptors are sent to it
+        return (rebuildDuplex, (DupFd(self.read_fd), DupFd(self.write_fd), self.oob))
+
     def __del__(self):
         self.reader.close()
         self.writer.close()
 
 
+def rebuildDuplex(read_df, write_df, oob):
+    return Duplex(read_df.detach(), write_df.detach(), oob = oob)
+
+
+class FlowControlProtocol(asyncio.Protocol):
+    """An asyncio protocol for a write transport: await ``drain`` after writing into the transport, so that the transport's
+    write buffer doesn't grow above its high-water mark
+    """
+    def __init__(self):
+        self.closed = False
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.n_paused = 0 # how many times the write buffer went above the high-water mark
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.can_write.set() # wake up drain
+
+    def pause_writing(self):
+        self.n_paused += 1
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    def isPaused(self) -> bool:
+        """Is the transport's write buffer above the high-water mark
+        """
+        return not self.can_write.is_set()
+
+    async def drain(self):
+        """Wait until the transport's write buffer is below its low-water mark
+        """
+        await self.can_write.wait()
+        if self.closed:
+            raise BrokenPipeError("connection lost")
+
+
+class FrameProtocol(asyncio.Protocol):
+    """An asyncio protocol that parses the length-prefixed frames (see ``to8ByteMessage`` and ``toOOBMessage``)
+    directly as the data arrives and decodes them into python objects.
+
+    All the objects decoded so far are fetched at once with ``recvAll``.  When the pipe is
+    closed, ``recvAll`` returns ``[None]``
+
+    :param codec: decodes the payload of non-oob frames.  Default: ``PickleCodec()``
+    """
+    def __init__(self, codec = None):
+        self.codec = PickleCodec() if codec is None else codec
+        self.header = bytearray()
+        self.body = None # preallocated memory for the frame being received
+        self.pos = 0
+        self.n_payload = None # pickle length in a non-oob frame, None for oob
+        self.objs = []
+        self.event = asyncio.Event()
+        self.closed = False
+        self.logger = logger
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.event.set()
+
+    def data_received(self, data):
+        mv = memoryview(data)
+        i = 0
+        n = len(mv)
+        while i < n:
+            if self.body is not None: # continue filling a frame
+                k = min(n - i, len(self.body) - self.pos)
+                self.body[self.pos:self.pos + k] = mv[i:i + k]
+                self.pos += k
+                i += k
+                if self.pos == len(self.body):
+                    self.frameDone__()
+                continue
+            if not self.header and n - i >= 8: # fast path: frame starts at i
+                N = int.from_bytes(mv[i:i + 8], byteorder = "big")
+                m = math.ceil(N/8)*8
+                if not (N & OOB_FLAG) and n - i >= m: # ..and is completely here
+                    self.decode__(mv[i + 8:i + N])
+                    i += m
+                    continue
+            k = min(8 - len(self.header), n - i)
+            self.header += mv[i:i + k]
+            i += k
+            if len(self.header) == 8:
+                N = int.from_bytes(self.header, byteorder = "big")
+                self.header = bytearray()
+                if N & OOB_FLAG:
+                    self.n_payload = None
+                    self.body = bytearray((N & ~OOB_FLAG) - 8)
+                else:
+                    self.n_payload = N - 8
+                    self.body = bytearray(math.ceil(N/8)*8 - 8)
+                self.pos = 0
+                if len(self.body) == 0:
+                    self.frameDone__()
+        if self.objs:
+            self.event.set()
+
+    def frameDone__(self):
+        body = self.body
+        self.body = None
+        if self.n_payload is None:
+            self.decode__(body, oob = True)
+        else:
+            self.decode__(memoryview(body)[0:self.n_payload])
+
+    def decode__(self, b, oob = False):
+        try:
+            if oob:
+                obj = fromOOBMessage(b)
+            else:
+                obj = self.codec.decode(b)
+        except Exception as e:
+            self.logger.critical("FrameProtocol: could not decode frame: %s", e)
+        else:
+            self.objs.append(obj)
+
+    async def recvAll(self) -> list:
+        """Wait until there are decoded objects and return all of them
+        """
+        while not self.objs:
+            if self.closed:
+                return [None]
+            self.event.clear()
+            await self.event.wait()
+        objs = self.objs
+        self.objs = []
+        return objs
+
+
 def exclog(f):
     """Decorator for coroutines: turns exceptions into logging events
     """
@@ -485,19 +1508,47 @@ class AsyncBackMessageProcess(MessageProcess):
     """A subclass of ``MessageProcess``, but now the backend runs asyncio
 
     :param name: multiprocess name
+    :param oob: use pickle protocol 5 with out-of-band buffers in the intercom: large bytearrays,
+                numpy arrays, etc. are written as-is with ``os.writev`` and read into preallocated memory.  Default: ``False``.
+    :param overflow: what ``send_out__`` does when the frontend doesn't read fast enough and the outgoing buffer is above its high-water mark:
+
+        - ``"unbounded"``: nothing, the outgoing buffer just grows (default)
+        - ``"block"``: wait until the buffer has drained below the low-water mark.  NOTE: while a ``c__`` method waits in ``send_out__``,
+          the backend doesn't handle any other commands, not even the stop request.  If the frontend stops reading, ``requestStop`` & ``waitStop``
+          hang until the process is terminated, so prefer ``stopProcesses`` with a timeout
+        - ``"drop-newest"``: drop the message that is being sent
+        - ``"drop-oldest"``: queue the message, dropping the oldest queued message if there are already ``max_queued`` of them
+
+    :param high_water: high-water mark of the outgoing buffer in bytes.  Default: asyncio's default (64 kB)
+    :param low_water: low-water mark of the outgoing buffer in bytes.  Default: a quarter of ``high_water``
+    :param max_queued: maximum number of queued messages with ``overflow = "drop-oldest"``
+    :param pipe_capacity: if not ``None``, kernel buffer size of the intercom pipes in bytes, set with ``F_SETPIPE_SZ``.  See ``getPipeCapacity``
+                          for what was granted.  Default: ``None`` (64 kB)
 
     NOTE: when subclassing ``__init__``, remember to call therein ``super().__init__()``
     """
-    def __init__(self, name = "AsyncMessageProcess"):
+    UNBOUNDED = "unbounded"
+    BLOCK = "block"
+    DROP_NEWEST = "drop-newest"
+    DROP_OLDEST = "drop-oldest"
+
+    def __init__(self, name = "AsyncMessageProcess", oob = False, overflow = "unbounded", high_water = None, low_water = None, max_queued = 100,
+                 pipe_capacity = None):
+        if overflow not in (self.UNBOUNDED, self.BLOCK, self.DROP_NEWEST, self.DROP_OLDEST):
+            raise ValueError("unknown overflow policy %s" % (overflow))
         # self.name = name
         #self.pre = self.__class__.__name__ + "." + self.name
         #self.logger = logging.getLogger(self.pre)
         super().__init__(name = name) # -> this takes care of the logger and self.name
         # self.front_pipe, self.back_pipe = getPipes(True, False) # blocking frontend, non-blocking backend (for asynchronous backend)
-        self.front_pipe, self.back_pipe = getPipes(True, True) # both blocking: for testing # seems to make no difference (asyncio sets the pipes to non-blocking mode)
+        self.front_pipe, self.back_pipe = getPipes(True, True, oob = oob, capacity = pipe_capacity) # both blocking: for testing # seems to make no difference (asyncio sets the pipes to non-blocking mode)
         self.loop = True
         self.listening = False # are we listening something else than just the intercom pipes?
         self.sigint = True
+        self.overflow = overflow
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_queued = max_queued
 
     def getPipe(self) -> Duplex:
         """Returns a Duplex object, instead of multiprocessing.Pipe object.
@@ -520,6 +1571,7 @@ class AsyncBackMessageProcess(MessageProcess):
         if self.sigint == False:
             signal.signal(signal.SIGINT, signal.SIG_IGN) # handle in master process correctly
         self.preRun__()
+        self.bindDispatchTable__() # see the c__ methods set to the instance in preRun__
         # very important! create a new separate event loop in the forked multiprocess
         loop_ = asyncio.new_event_loop()
         asyncio.set_event_loop(loop_)
@@ -559,23 +1611,26 @@ class AsyncBackMessageProcess(MessageProcess):
         back_reader = self.back_pipe.getReadIO()
         back_writer = self.back_pipe.getWriteIO()
 
-        self.stream_reader = asyncio.StreamReader()
-        def protocol_factory():
-            return asyncio.StreamReaderProtocol(self.stream_reader)
+        self.back_protocol = FrameProtocol(codec = self.codec)
             
         """the logic here:
 
         read input (back_reader) is connected to the event loop, using
         a certain protocol .. protocol == what happens when there is
-        stuff to read.  We'll do the reading "manually" in the loop,
-        so nothing much
+        stuff to read.  FrameProtocol decodes all complete frames
+        as soon as they arrive
 
         same for writer.. we get writer_transport where we can write
         """
         self.reader_transport, pro =\
-            await loop.connect_read_pipe(protocol_factory, back_reader)
-        self.writer_transport, pro =\
-            await loop.connect_write_pipe(asyncio.BaseProtocol, back_writer)
+            await loop.connect_read_pipe(lambda: self.back_protocol, back_reader)
+        self.writer_transport, self.writer_protocol =\
+            await loop.connect_write_pipe(FlowControlProtocol, back_writer)
+        if self.high_water is not None or self.low_water is not None:
+            self.writer_transport.set_write_buffer_limits(high = self.high_water, low = self.low_water)
+        self.out_queue = deque() # messages waiting for the buffer to drain, with overflow "drop-oldest"
+        self.flush_task = None
+        self.n_dropped = 0
 
         try:
             await self.asyncPre__()
@@ -587,33 +1642,12 @@ class AsyncBackMessageProcess(MessageProcess):
 
         # ..cause the loop starts over here:
         while self.loop:
-            # TODO: we should not have any event/reading loops
-            # when using asyncio, so this is a bit stupid
-            # solution: define a proper protocol instead
-            #
             # if you have file descriptors, add them to the event loop
-            # like this: loop.add_reader(fd, callback, *args)
-            msg = b''
-            N = None
-            cc = 0
-            while True:
-                # print("waiting stream")
-                res = await self.stream_reader.read(8)
-                cc += 8
-                if N is None:
-                    # decode the first 8 bytes into int
-                    N = int.from_bytes(res, byteorder = "big")
-                    # print("N>", N)
-                # print(res, len(res))
-                msg += res
-                if cc >= N:
+            # with registerFd__(fd, callback, *args)
+            for obj in await self.back_protocol.recvAll():
+                await self.routeMainPipe__(obj)
+                if not self.loop:
                     break
-            msg = msg[8:N] # remove any padding bytes
-            #"""
-            #msg = await stream_reader.read(4096)
-            obj = pickle.loads(msg)
-            # print("obj", obj)
-            await self.routeMainPipe__(obj)
 
         self.reader_transport.close()
         self.writer_transport.close()
@@ -622,6 +1656,25 @@ class AsyncBackMessageProcess(MessageProcess):
         self.logger.debug("bye!")
         
 
+    def registerFd__(self, fd, callback, *args):
+        """Multiprocessing backend method: start listening a file descriptor in the backend's asyncio event loop.
+        Call this in ``asyncPre__`` or in any of the ``c__`` methods.
+
+        :param fd: a file descriptor (int) or an object having the ``fileno`` method, say, a socket, a pipe or an ``EventFd``
+        :param callback: called as ``callback(*args)`` when ``fd`` is ready for reading.  A plain function, not a coroutine:
+                         to await something, schedule it with ``asyncio.ensure_future``
+
+        Same as ``asyncio.get_event_loop().add_reader(fd, callback, *args)``, which you can of course use directly as well.
+        """
+        asyncio.get_event_loop().add_reader(fd, callback, *args)
+
+    def unregisterFd__(self, fd):
+        """Multiprocessing backend method: stop listening a file descriptor
+
+        :param fd: a file descriptor or an object, as given to ``registerFd__``
+        """
+        asyncio.get_event_loop().remove_reader(fd)
+
     async def readPipes__(self, timeout):
         """Multiplex all intercom pipes
         """
@@ -654,32 +1707,94 @@ class AsyncBackMessageProcess(MessageProcess):
             self.loop = False
             return
 
-        method_name = "c__%s" % (obj.command)
-        if hasattr(self, method_name):
-            method = getattr(self, method_name)
-            # print("method = ", method)
+        method = self.dispatch_table.get(obj.command)
+        if method is None:
+            method = self.getMethod__(obj.command)
+        kwargs = arraysFromShmem(obj.kwargs) # also releases shared memory, if there is no method
+        if method is None:
+            self.logger.warning("routeMainPipe : no such method c__%s" %(obj.command))
+            if obj.call_id is not None:
+                self.returnCall__(CallResult(obj.call_id, exception = AttributeError("no such method c__%s" % (obj.command))))
+            return
+        # print("method = ", method)
+        if obj.call_id is not None:
             try:
-                await method(**obj.kwargs)
-            except TypeError as e:
-                self.logger.warning("routeMainPipe : could not call method %s with parameters %s: %s" % (method_name, obj.kwargs, e))
-                raise
-        else:
-            self.logger.warning("routeMainPipe : no such method %s" %(method_name))
+                value = await method(**kwargs)
+            except Exception as e:
+                self.returnCall__(CallResult(obj.call_id, exception = e))
+            else:
+                self.returnCall__(CallResult(obj.call_id, value = value))
+            return
+        try:
+            await method(**kwargs)
+        except TypeError as e:
+            self.logger.warning("routeMainPipe : could not call method c__%s with parameters %s: %s" % (obj.command, obj.kwargs, e))
+            raise
 
 
-    async def send_out__(self, obj):
+    async def send_out__(self, obj) -> bool:
         """Multiprocessing backend coroutine: pickle obj & send to main python process.
         It's recommended to use the ``MessageObject`` class.
+
+        If the frontend doesn't keep up, does what the ``overflow`` policy says.  Returns ``False`` if the message was dropped
         """
-        #print("send_out__", obj, self.writer_transport)
-        msg = to8ByteMessage(obj)
-        # self.back_pipe.send(obj)
-        #try:
-        # print("send_out__", msg)
-        self.writer_transport.write(msg) # woops.. this is _not_ async call (it returns immediately)
-        #except Exception as e:
-        #    print("send_out__ failed with", e)
-        #print("send_out__: exit")
+        if self.back_pipe.oob:
+            buffers = toOOBMessage(obj)
+        else:
+            buffers = [to8ByteMessage(obj)]
+        if self.overflow == self.UNBOUNDED:
+            self.write__(buffers) # not an async call: returns immediately
+            return True
+        if self.overflow == self.BLOCK:
+            self.write__(buffers)
+            await self.writer_protocol.drain() # the transport write is not async: wait here if the buffer is too full
+            return True
+        if self.overflow == self.DROP_NEWEST:
+            if self.writer_protocol.isPaused():
+                self.n_dropped += 1
+                return False
+            self.write__(buffers)
+            return True
+        # drop oldest
+        if not self.out_queue and not self.writer_protocol.isPaused():
+            self.write__(buffers)
+            return True
+        self.out_queue.append(buffers)
+        if len(self.out_queue) > self.max_queued:
+            self.out_queue.popleft()
+            self.n_dropped += 1
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flushQueue__())
+        return True
+
+    def write__(self, buffers):
+        if self.back_pipe.oob:
+            writevTransport(self.writer_transport, self.back_pipe.getWriteFd(), buffers)
+        else:
+            self.writer_transport.write(buffers[0])
+
+    async def flushQueue__(self):
+        """Write the queued messages as the buffer drains
+        """
+        try:
+            while self.out_queue:
+                await self.writer_protocol.drain()
+                self.write__(self.out_queue.popleft())
+        except BrokenPipeError:
+            self.out_queue.clear()
+        finally:
+            self.flush_task = None
+
+    def getSendStats__(self) -> dict:
+        """Multiprocessing backend method: returns a dictionary with keys ``buffered`` (bytes in the outgoing buffer), ``queued`` (messages queued
+        with overflow "drop-oldest"), ``dropped`` (messages) and ``paused`` (how many times the buffer went above the high-water mark)
+        """
+        return {
+            "buffered": self.writer_transport.get_write_buffer_size(),
+            "queued": len(self.out_queue),
+            "dropped": self.n_dropped,
+            "paused": self.writer_protocol.n_paused
+        }
 
 
     # ***  _your_ backend methods ***
@@ -692,10 +1807,310 @@ class AsyncBackMessageProcess(MessageProcess):
         print("c__ping:", lis)
         await self.send_out__(MessageObject("pong", lis = [1,2,3]))
 
+    async def c__getSendStats(self):
+        """Returns ``getSendStats__`` to the frontend: use ``call("getSendStats")``
+        """
+        return self.getSendStats__()
+
 
     def sendMessageToBack(self, message: MessageObject):
         # print("writing to", self.front_pipe.write_fd)
-        self.front_pipe.send(message)
+        if self.nonblocking_send:
+            if self.front_pipe.oob:
+                self.queueSend__(toOOBMessage(self.packMessage(message)))
+            else:
+                self.queueSend__(self.getSendQueue__().frame(self.codec.encode(self.packMessage(message))))
+            return
+        if self.front_pipe.oob: # large buffers are written as-is
+            self.front_pipe.send(self.packMessage(message))
+        else:
+            self.front_pipe.send_bytes(self.codec.encode(self.packMessage(message)))
+
+    def sendMessagesToBack(self, messages):
+        if self.nonblocking_send:
+            for message in messages: # one frame per message, like below
+                self.sendMessageToBack(message)
+            return
+        if self.front_pipe.oob:
+            self.front_pipe.sendMany([self.packMessage(message) for message in messages])
+        else:
+            self.front_pipe.sendManyBytes([self.codec.encode(self.packMessage(message)) for message in messages])
+
+
+STREAM_CHUNK = 65536 # bytes read at a time by readBackStream__
+
+
+class ConnectionFrameReader:
+    """Reassembles the frames written by ``multiprocessing.Connection`` (a 4 byte length header, or -1 and
+    an 8 byte length for huge frames, followed by the payload) from a byte stream that arrives in pieces and decodes them
+
+    :param codec: decodes the payloads.  Default: ``PickleCodec()``
+    """
+    def __init__(self, codec = None):
+        self.codec = PickleCodec() if codec is None else codec
+        self.buf = bytearray()
+        self.logger = logger
+
+    def feed(self, data) -> list:
+        """Add bytes to the stream.  Returns the list of objects decoded from the frames completed so far
+        """
+        self.buf += data
+        objs = []
+        i = 0
+        n = len(self.buf)
+        mv = memoryview(self.buf)
+        try:
+            while n - i >= 4:
+                size, = struct.unpack_from("!i", mv, i)
+                start = i + 4
+                if size == -1:
+                    if n - i < 12:
+                        break
+                    size, = struct.unpack_from("!Q", mv, start)
+                    start += 8
+                if n - start < size:
+                    break
+                try:
+                    objs.append(self.codec.decode(mv[start:start + size]))
+                except Exception as e:
+                    self.logger.critical("ConnectionFrameReader: could not decode frame: %s", e)
+                i = start + size
+        finally:
+            mv.release()
+        if i > 0:
+            del self.buf[:i]
+        return objs
+
+
+def toConnectionFrame(b):
+    """Frame an encoded payload like ``multiprocessing.Connection.send_bytes`` does
+    """
+    n = len(b)
+    if n > 0x7fffffff:
+        return struct.pack("!iQ", -1, n) + b
+    return struct.pack("!i", n) + b
+
+
+class ConnectionProtocol(FlowControlProtocol):
+    """An asyncio protocol that parses the frames written by ``multiprocessing.Connection`` (a 4 byte length header, or -1 and
+    an 8 byte length for huge frames, followed by the payload) and decodes them
+
+    :param callback: called with each decoded object.  Called with ``None`` when the connection is lost
+    :param codec: decodes the payloads.  Default: ``PickleCodec()``
+
+    Implements also flow control for writing: await ``drain`` after writing into the transport
+    """
+    def __init__(self, callback, codec = None):
+        super().__init__()
+        self.callback = callback
+        self.reader = ConnectionFrameReader(codec)
+
+    def data_received(self, data):
+        for obj in self.reader.feed(data):
+            self.callback(obj)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.callback(None)
+
+
+class AsyncFrontMessageProcess(MessageProcess):
+    """A subclass of ``MessageProcess`` for an asyncio frontend (i.e. main process).  The backend is the same as in ``MessageProcess``.
+
+    The intercom pipes are connected to the running asyncio event loop, so nothing blocks the loop:
+
+    ::
+
+        p = MyProcess()
+        await p.startAsync()
+        await p.send(MessageObject("myStuff", par = 1))
+        result = await p.call("compute", x = 2)
+        async for msg in p: # messages sent by the backend with send_out__
+            ...
+        await p.stopAsync()
+
+    :param name: multiprocess name
+
+    NOTE: when subclassing ``__init__``, remember to call therein ``super().__init__()``
+    """
+    def __init__(self, name = "AsyncFrontMessageProcess"):
+        super().__init__(name = name)
+        self.front_transport = None
+        self.front_protocol = None
+        self.internal_transport = None
+        self.messages = None # asyncio.Queue of the messages from the backend
+
+    async def startAsync(self):
+        """Multiprocessing frontend coroutine: start the multiprocess and connect the intercom pipes to the running event loop
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        self.messages = asyncio.Queue()
+        # the sockets are duplicated, so that Connection objects & transports can be closed independently
+        self.front_transport, self.front_protocol = await loop.create_unix_connection(
+            lambda: ConnectionProtocol(self.messageFromBack__),
+            sock = socket.socket(fileno = os.dup(self.front_pipe.fileno())))
+        self.internal_transport, pro = await loop.create_unix_connection(
+            lambda: ConnectionProtocol(self.returnFromBack__),
+            sock = socket.socket(fileno = os.dup(self.front_pipe_internal.fileno())))
+
+    def messageFromBack__(self, obj):
+        self.messages.put_nowait(obj) # None means that the backend exited
+
+    def returnFromBack__(self, obj):
+        if obj is None: # connection lost: backend exited
+            for call_id in list(self.futures.keys()):
+                future = self.futures.pop(call_id)
+                if not future.done():
+                    future.set_exception(BrokenPipeError("multiprocessing backend has exited"))
+        elif obj.__class__ is CallResult:
+            future = self.futures.pop(obj.call_id, None)
+            if future is None or future.done(): # cancelled
+                return
+            if obj.exception is None:
+                future.set_result(obj.value)
+            else:
+                future.set_exception(obj.exception)
+        else:
+            self.return_queue.put(obj)
+
+    def sendMessageToBack(self, message: MessageObject):
+        """Multiprocessing frontend method: send a ``MessageObject`` to multiprocessing backend.  Does not block:
+        if the pipe is full, the message is buffered by the asyncio transport.  Use ``send`` to wait for the buffer to drain.
+        """
+        if self.front_transport is None: # not connected yet
+            super().sendMessageToBack(message)
+            return
+        self.front_transport.write(toConnectionFrame(self.codec.encode(self.packMessage(message))))
+
+    def sendMessagesToBack(self, messages):
+        if self.front_transport is None:
+            super().sendMessagesToBack(messages)
+            return
+        self.front_transport.write(toConnectionFrame(self.codec.encodeMany([self.packMessage(message) for message in messages])))
+
+    async def send(self, message: MessageObject):
+        """Multiprocessing frontend coroutine: send a ``MessageObject`` to multiprocessing backend
+        and wait until the pipe can take more
+        """
+        self.sendMessageToBack(message)
+        await self.front_protocol.drain()
+
+    async def call(self, command, **kwargs):
+        """Multiprocessing frontend coroutine: send a ``MessageObject`` to multiprocessing backend and
+        return the return value of the backend method ``c__command``.  If the backend method raises an exception,
+        it is raised here.
+
+        Several calls can be in flight at the same time, say, with ``asyncio.gather``
+        """
+        message = MessageObject(command, **kwargs)
+        message.call_id = next(self.call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[message.call_id] = future
+        await self.send(message)
+        return await future
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Next message sent by the backend.  Iteration ends when the backend exits
+        """
+        obj = await self.messages.get()
+        if obj is None:
+            self.messages.put_nowait(None) # for other consumers
+            raise StopAsyncIteration
+        return obj
+
+    async def waitStopAsync(self):
+        """Multiprocessing frontend coroutine: wait until the backend has exited, without blocking the event loop
+        """
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+        def callback():
+            loop.remove_reader(self.sentinel)
+            if not exited.done():
+                exited.set_result(None)
+        loop.add_reader(self.sentinel, callback)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(self.sentinel)
+        self.join() # exited already: does not block
+        self.front_transport.close()
+        self.internal_transport.close()
+
+    async def stopAsync(self):
+        """Multiprocessing frontend coroutine: request backend multiprocess to stop and wait until it has finished
+        """
+        self.requestStop()
+        await self.waitStopAsync()
+
+
+FLUSH_INTERVAL = 0.01 # seconds between the writes of the send queues in stopProcesses
+
+
+def stopProcesses(processes, timeout = 10.0, term_timeout = 2.0) -> dict:
+    """Stop a group of ``MessageProcess`` es in parallel, in bounded time
+
+    :param processes: list of ``MessageProcess`` es
+    :param timeout: seconds to wait for all of them to exit after the stop request
+    :param term_timeout: seconds to wait after ``SIGTERM`` before ``SIGKILL``
+
+    The stop request is sent to all multiprocesses at once (but only to those whose intercom pipe is not full:
+    a hung backend would block the sending), then their sentinels are waited together.  For multiprocesses with ``nonblocking_send``
+    the stop request is queued after the other queued messages, and the queues are written while waiting.
+    Multiprocesses still running at the deadline get ``SIGTERM`` and after that, ``SIGKILL``.
+
+    Returns a dictionary with lists of multiprocesses: ``stopped`` (exited cleanly), ``terminated``
+    (exited after ``SIGTERM``) and ``killed``
+    """
+    report = {"stopped": [], "terminated": [], "killed": []}
+    running = []
+    for p in processes:
+        if p._popen is None or p.exitcode is not None: # never started or already exited
+            report["stopped"].append(p)
+            continue
+        running.append(p)
+        if p.nonblocking_send: # never blocks
+            p.requestStop()
+        elif p.isWritable():
+            p.requestStop()
+        else:
+            logger.warning("stopProcesses: intercom pipe of %s is full: can't request stop", p.name)
+
+    def waitAll(procs, dt):
+        deadline = time.monotonic() + dt
+        procs = list(procs)
+        while procs:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            flushing = [p for p in procs if not p.flushSendQueue()]
+            if flushing: # check the queues now and then
+                remaining = min(remaining, FLUSH_INTERVAL)
+            ready = wait([p.sentinel for p in procs], timeout = remaining)
+            procs = [p for p in procs if p.sentinel not in ready]
+        return procs
+
+    left = waitAll(running, timeout)
+    for p in running:
+        if p not in left:
+            report["stopped"].append(p)
+    if left:
+        for p in left:
+            logger.warning("stopProcesses: %s did not stop in %s s: sending SIGTERM", p.name, timeout)
+            p.terminate()
+        killed = waitAll(left, term_timeout)
+        for p in killed:
+            logger.warning("stopProcesses: %s did not exit after SIGTERM: sending SIGKILL", p.name)
+            p.kill()
+        waitAll(killed, term_timeout)
+        report["terminated"] = [p for p in left if p not in killed]
+        report["killed"] = killed
+    for p in running:
+        p.join(timeout = 0) # reap
+    return report
 
 
 class MainContext:
@@ -722,11 +2137,17 @@ class MainContext:
     ``MainContext`` has a logger ``self.logger`` with the name
     ``classname``.
 
+    ``MainContext`` has also a ``ProcessSelector`` instance ``self.selector``, where you
+    can register your processes in ``startProcesses``, and then listen to all of them in ``__call__``
+    with ``self.selector.select``.  ``self.aux_pipe_read`` is already registered.
+
     """
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.started = False
         self.aux_pipe_read, self.aux_pipe_write = Pipe()  # when using runAsThread
+        self.selector = ProcessSelector() # register your processes here: see ProcessSelector
+        self.selector.register(self.aux_pipe_read)
         self.startProcesses()
         self.startThreads()
 
@@ -0,0 +1,483 @@
+"""benchmark.py : Benchmarks for the intercom between multiprocessing front- and backend
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    benchmark.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   Benchmarks for the intercom between multiprocessing front- and backend
+
+Run with:
+
+::
+
+    python3 -m valkka.multiprocess.benchmark duplex|dispatch|codec|call|pool|zygote [module ...]|slab|mailbox|bus|capacity
+"""
+import sys
+import time
+import random
+import importlib
+from valkka.multiprocess.base import MessageProcess, AsyncBackMessageProcess, MessageObject
+from multiprocessing import shared_memory
+from valkka.multiprocess.shmem import arraysFromShmem, SlabPool
+from valkka.multiprocess.codec import PickleCodec, BinaryCodec
+from valkka.multiprocess.pool import MessageProcessPool
+from valkka.multiprocess.zygote import Zygote
+from valkka.multiprocess.mailbox import FrameMailbox
+from valkka.multiprocess.bus import BroadcastBus
+try:
+    import numpy as np
+except ImportError: # numpy is optional
+    np = None
+
+
+class BlobProcess(AsyncBackMessageProcess):
+    """Sends blobs of bytes from the asyncio backend to the frontend
+    """
+    async def c__blobs(self, size = None, n = None):
+        blob = bytearray(size)
+        for i in range(n):
+            await self.send_out__(MessageObject("blob", blob = blob))
+
+    def blobs(self, size, n):
+        self.sendMessageToBack(MessageObject("blobs", size = size, n = n))
+
+
+def benchDuplex(oob = False):
+    """Throughput of ``Duplex.recv`` at the frontend, for messages from 1 kB to 64 MB
+    sent by an ``AsyncBackMessageProcess``
+    """
+    p = BlobProcess(name = "bench", oob = oob)
+    pipe = p.getPipe()
+    p.start()
+    print("Duplex.recv throughput, oob =", oob)
+    print("%12s %10s %12s %12s" % ("size (B)", "messages", "MB/s", "msg/s"))
+    size = 1024
+    while size <= 64*1024*1024:
+        n = max(4, min(2000, (256*1024*1024) // size))
+        p.blobs(size, n)
+        t = time.perf_counter()
+        for i in range(n):
+            obj = pipe.recv()
+            assert len(obj["blob"]) == size
+        dt = time.perf_counter() - t
+        print("%12i %10i %12.1f %12.1f" % (size, n, n*size/dt/1e6, n/dt))
+        size *= 4
+    p.stop()
+
+
+class DispatchProcess(MessageProcess):
+    """Has a bunch of ``c__`` methods, like a real-life process would
+
+    Its backend methods are called directly in the frontend, no forking here
+    """
+    def __init__(self, name = "dispatch"):
+        super().__init__(name = name)
+        self.shmem_threshold = None
+        self.counter = 0
+
+    def routeByName__(self, obj):
+        """Routing like it was done before the dispatch table
+        """
+        method_name = "c__%s" % (obj.command)
+        if hasattr(self, method_name):
+            method = getattr(self, method_name)
+            kwargs = arraysFromShmem(obj.kwargs)
+            try:
+                method(**kwargs)
+            except TypeError:
+                raise
+
+    def c__count(self, n = 1):
+        self.counter += n
+
+for i in range(20):
+    setattr(DispatchProcess, "c__dummy%i" % i, lambda self: None)
+
+
+def benchDispatch(n = 1000000):
+    """Cost of routing a ``MessageObject`` to its ``c__`` method in the backend
+    """
+    p = DispatchProcess()
+    print("dispatch cost per message")
+    cases = (
+        ("getattr", MessageObject("count", n = 1), p.routeByName__),
+        ("dispatch table", MessageObject("count", n = 1), p.routeMainPipe__),
+        ("dispatch table, opcode", MessageObject(p.opcodes["count"], n = 1), p.routeMainPipe__)
+    )
+    for name, msg, route in cases:
+        t = time.perf_counter()
+        for i in range(n):
+            route(msg)
+        dt = time.perf_counter() - t
+        print("%25s %8.1f ns" % (name, dt/n*1e9))
+
+
+def checkCodec():
+    """Round trip of the payloads that ``BinaryCodec`` can't encode natively and must pickle instead
+    """
+    codec = BinaryCodec(MessageObject)
+    messages = [
+        ("lone surrogate", MessageObject("text", s = "a\udc80b")),
+        ("lone surrogate key", MessageObject("text", **{"s\udc80": 1})),
+        ("lone surrogate command", MessageObject("text\udc80", s = "ok"))
+    ]
+    if np is not None:
+        messages.append(("zero-size ndarray", MessageObject("array", a = np.zeros((0, 3)))))
+        messages.append(("datetime64 ndarray", MessageObject("array", a = np.array(["2023-01-01", "2023-06-01"], dtype = "datetime64[D]"))))
+        messages.append(("timedelta64 ndarray", MessageObject("array", a = np.array([1, 2], dtype = "timedelta64[s]"))))
+    for name, msg in messages:
+        obj = codec.decode(codec.encode(msg))
+        assert obj.command == msg.command, name
+        assert obj.kwargs.keys() == msg.kwargs.keys(), name
+        for key, value in msg.kwargs.items():
+            if np is not None and isinstance(value, np.ndarray):
+                assert obj.kwargs[key].dtype == value.dtype and obj.kwargs[key].shape == value.shape, name
+                assert np.array_equal(obj.kwargs[key], value), name
+            else:
+                assert obj.kwargs[key] == value, name
+        print("round trip ok:", name)
+    batch = [msg for name, msg in messages] + [MessageObject("count", n = 1), MessageObject("config", d = {"a": 1})]
+    objs = codec.decode(codec.encodeMany(batch))
+    assert [obj.command for obj in objs] == [msg.command for msg in batch], "batch"
+    print("round trip ok: batch of %i messages" % (len(batch)))
+
+
+def benchCodec(n = 100000):
+    """Per-message encode & decode time and payload size of the codecs
+    """
+    codecs = (PickleCodec(), BinaryCodec(MessageObject))
+    messages = [
+        ("command only", MessageObject("ping")),
+        ("int", MessageObject("count", n = 1)),
+        ("scalars", MessageObject("setParams", x = 1.5, y = 2, name = "camera-1", flag = True)),
+        ("list", MessageObject("setSlots", slots = [1, 2, 3, 4])),
+        ("1 kB bytes", MessageObject("frame", data = bytes(1024)))
+    ]
+    if np is not None:
+        messages.append(("ndarray 10x10", MessageObject("array", a = np.zeros((10, 10), dtype = np.float32))))
+    messages.append(("dict (fallback)", MessageObject("config", d = {"a": 1})))
+    print("codec cost per message")
+    print("%18s %8s %10s %12s %12s" % ("message", "codec", "size (B)", "encode (ns)", "decode (ns)"))
+    for name, msg in messages:
+        for codec in codecs:
+            b = codec.encode(msg)
+            t = time.perf_counter()
+            for i in range(n):
+                codec.encode(msg)
+            dt_encode = time.perf_counter() - t
+            t = time.perf_counter()
+            for i in range(n):
+                codec.decode(b)
+            dt_decode = time.perf_counter() - t
+            print("%18s %8s %10i %12.1f %12.1f" % (name, codec.name, len(b), dt_encode/n*1e9, dt_decode/n*1e9))
+
+
+class SquareProcess(MessageProcess):
+    """Returns values to ``call``
+    """
+    def c__square(self, x = 0):
+        return x*x
+
+
+def benchCall(n = 10000):
+    """Round-trips per second with ``call``: waiting for each result before the next call vs.
+    having all calls in flight at once
+    """
+    p = SquareProcess(name = "bench")
+    p.start()
+    print("call round-trips per second")
+    t = time.perf_counter()
+    for i in range(n):
+        p.call("square", x = i).result()
+    dt = time.perf_counter() - t
+    print("%12s %12.1f" % ("lock-step", n/dt))
+    t = time.perf_counter()
+    futures = [p.call("square", x = i) for i in range(n)]
+    for future in futures:
+        future.result()
+    dt = time.perf_counter() - t
+    print("%12s %12.1f" % ("pipelined", n/dt))
+    p.stop()
+
+
+class WorkProcess(MessageProcess):
+    """Does work that takes a given time
+    """
+    def c__work(self, t = 0.0):
+        time.sleep(t)
+
+
+def benchPool(n = 400, n_processes = 4):
+    """Throughput of ``MessageProcessPool`` with different policies, when most of the calls are
+    quick and some are slow
+    """
+    print("pool throughput with %i multiprocesses" % (n_processes))
+    print("%20s %12s" % ("policy", "calls/s"))
+    for policy in (MessageProcessPool.ROUND_ROBIN, MessageProcessPool.LEAST_OUTSTANDING, MessageProcessPool.FIRST_IDLE):
+        pool = MessageProcessPool(WorkProcess, n = n_processes, policy = policy, name = "bench")
+        pool.start()
+        random.seed(0)
+        futures = [pool.call("work", t = random.choice((0.001, 0.001, 0.001, 0.02))) for i in range(n)]
+        for future in futures:
+            future.result()
+        print("%20s %12.1f" % (policy, pool.getThroughput()))
+        pool.stop()
+
+
+class ImportProcess(MessageProcess):
+    """Imports heavy modules after the fork, as recommended in ``preRun__``
+    """
+    def __init__(self, name = "import", modules = []):
+        super().__init__(name = name)
+        self.modules = modules
+
+    def preRun__(self):
+        for module in self.modules:
+            importlib.import_module(module)
+
+    def c__ready(self):
+        return True
+
+
+def benchZygote(modules = ["asyncio", "json", "decimal", "unittest", "http.server", "xml.dom.minidom", "email.mime.multipart"], n = 5):
+    """Time from starting a multiprocess until it answers its first call, when the multiprocess imports modules in ``preRun__``:
+    plain fork vs. started from a ``Zygote`` that has preloaded the modules
+    """
+    print("startup time, importing", modules)
+    zygote = Zygote(modules)
+    p = ImportProcess(modules = modules) # wait for the zygote to be ready
+    zygote.start(p)
+    p.call("ready").result()
+    p.stop()
+    for name, start in (("fork", lambda p: p.start()), ("zygote", zygote.start)):
+        dt = 0.0
+        for i in range(n):
+            p = ImportProcess(modules = modules)
+            t = time.perf_counter()
+            start(p)
+            p.call("ready").result()
+            dt += time.perf_counter() - t
+            p.stop()
+        print("%12s %12.1f ms" % (name, dt/n*1000))
+
+
+def benchSlab(n = 2000):
+    """Cost of getting a shared memory buffer for a frame, writing the frame and releasing the buffer:
+    a shared memory segment per frame vs. a ``SlabPool`` block
+    """
+    sizes = (64*1024, 1024*1024, 8*1024*1024)
+    pool = SlabPool({size: 4 for size in sizes})
+    print("shared memory buffer per frame (allocate, write, free)")
+    print("%12s %16s %16s" % ("size (B)", "segment (us)", "SlabPool (us)"))
+    for size in sizes:
+        frame = bytes(size)
+        t = time.perf_counter()
+        for i in range(n):
+            shmem = shared_memory.SharedMemory(create = True, size = size)
+            shmem.buf[:size] = frame
+            shmem.close()
+            shmem.unlink()
+        dt_segment = time.perf_counter() - t
+        t = time.perf_counter()
+        for i in range(n):
+            block = pool.write(frame)
+            pool.free(block)
+        dt_slab = time.perf_counter() - t
+        print("%12i %16.1f %16.1f" % (size, dt_segment/n*1e6, dt_slab/n*1e6))
+    pool.unlink()
+
+
+class CameraProcess(MessageProcess):
+    """Writes frames into a ``FrameMailbox`` as fast as it can
+    """
+    def __init__(self, name = "camera", shape = (720, 1280, 3)):
+        super().__init__(name = name)
+        self.mailbox = FrameMailbox(shape, np.uint8)
+
+    def c__produce(self, t = 1.0):
+        frame = np.zeros(self.mailbox.shape, np.uint8)
+        t_end = time.monotonic() + t
+        while time.monotonic() < t_end:
+            self.mailbox.write(frame)
+
+
+class AnalyzerProcess(MessageProcess):
+    """Reads frames from a ``FrameMailbox`` in the backend: the mailbox is listened with ``registerFd__``,
+    so the backend sleeps in its main loop until there is a new frame
+    """
+    def __init__(self, name = "analyzer", shape = (720, 1280, 3), work = 0.01):
+        super().__init__(name = name)
+        self.mailbox = FrameMailbox(shape, np.uint8, notify = True)
+        self.work = work
+
+    def preRun__(self):
+        self.frame__ = np.zeros(self.mailbox.shape, np.uint8)
+        self.registerFd__(self.mailbox, self.onFrame__)
+
+    def onFrame__(self):
+        if self.mailbox.read(self.frame__) is not None:
+            time.sleep(self.work) # analyze self.frame__
+
+    def c__getMailboxStats(self):
+        return self.mailbox.getStats()
+
+
+def benchMailbox(t = 2.0, work = 0.01):
+    """A backend writes 720p frames into a ``FrameMailbox`` as fast as it can, while the frontend reads them
+    and spends ``work`` seconds with each one.  Then the other way around: the frontend writes and the backend
+    reads (see ``AnalyzerProcess``)
+    """
+    p = CameraProcess()
+    p.start()
+    frame = np.zeros(p.mailbox.shape, np.uint8)
+    future = p.call("produce", t = t)
+    t_start = time.perf_counter()
+    while not future.done():
+        if p.mailbox.read(frame) is not None:
+            time.sleep(work)
+    dt = time.perf_counter() - t_start
+    stats = p.mailbox.getStats()
+    print("FrameMailbox with 720p frames")
+    print("%12s %12s %12s %12s" % ("written/s", "read/s", "skipped", "torn"))
+    print("%12.1f %12.1f %12i %12i" % (stats["latest"]/dt, stats["read"]/dt, stats["skipped"], stats["torn"]))
+    p.stop()
+    p = AnalyzerProcess(work = work)
+    p.start()
+    frame = np.zeros(p.mailbox.shape, np.uint8)
+    t_start = time.perf_counter()
+    while time.perf_counter() - t_start < t:
+        p.mailbox.write(frame)
+    dt = time.perf_counter() - t_start
+    time.sleep(2*work) # let the backend read the last frame
+    stats = p.call("getMailboxStats").result()
+    print("%12.1f %12.1f %12i %12i   (backend reading with registerFd__)" % (stats["latest"]/dt, stats["read"]/dt, stats["skipped"], stats["torn"]))
+    p.stop()
+
+
+def benchBus(n = 200):
+    """Cost of publishing a 720p frame to a number of readers with ``BroadcastBus`` vs. copying the frame
+    into shared memory separately for each reader
+    """
+    shape = (720, 1280, 3)
+    frame = np.zeros(shape, np.uint8)
+    print("fan-out of a 720p frame")
+    print("%12s %16s %16s" % ("readers", "bus (us)", "per-reader (us)"))
+    for n_readers in (1, 2, 4, 8):
+        bus = BroadcastBus(shape, np.uint8, n_slots = 4, max_readers = 8)
+        readers = [bus.subscribe() for i in range(n_readers)]
+        for i in range(n): # page in the shared memory
+            bus.publish(frame)
+        t = time.perf_counter()
+        for i in range(n):
+            bus.publish(frame)
+        dt_bus = time.perf_counter() - t
+        targets = [np.ones(shape, np.uint8) for i in range(n_readers)]
+        t = time.perf_counter()
+        for i in range(n):
+            for target in targets:
+                np.copyto(target, frame)
+        dt_copy = time.perf_counter() - t
+        print("%12i %16.1f %16.1f" % (n_readers, dt_bus/n*1e6, dt_copy/n*1e6))
+        del readers
+        bus.unlink()
+
+
+class SinkProcess(MessageProcess):
+    """Receives blobs of bytes in the backend
+    """
+    def preRun__(self):
+        self.received = 0
+
+    def c__blob(self, blob = None):
+        self.received += len(blob)
+
+    def c__received(self):
+        return self.received
+
+
+def benchCapacity(total = 256*1024*1024, capacities = (None, 256*1024, 1024*1024, 4*1024*1024)):
+    """Throughput of medium-sized messages with different kernel buffer sizes (``pipe_capacity``) of the intercom channel:
+    frontend to backend with ``MessageProcess`` and backend to frontend with ``AsyncBackMessageProcess``
+    """
+    print("throughput (MB/s) vs. pipe_capacity")
+    print("%40s %10s %10s %12s %12s" % ("", "capacity", "granted", "32 kB", "256 kB"))
+    for capacity in capacities:
+        results = []
+        for size in (32*1024, 256*1024):
+            n = total // size
+            p = SinkProcess(name = "bench", pipe_capacity = capacity)
+            p.shmem_threshold = None
+            granted = p.getPipeCapacity()["to_back"]
+            p.start()
+            blob = bytes(size)
+            t = time.perf_counter()
+            for i in range(n):
+                p.sendMessageToBack(MessageObject("blob", blob = blob))
+            assert p.call("received").result() == n*size
+            results.append(n*size/(time.perf_counter() - t)/1e6)
+            p.stop()
+        print("%40s %10s %10s %12.1f %12.1f" % ("MessageProcess, to backend", capacity, granted, *results))
+    for capacity in capacities:
+        results = []
+        for size in (32*1024, 256*1024):
+            n = total // size
+            p = BlobProcess(name = "bench", pipe_capacity = capacity)
+            pipe = p.getPipe()
+            granted = p.getPipeCapacity()["to_front"]
+            p.start()
+            t = time.perf_counter()
+            p.blobs(size, n)
+            for i in range(n):
+                pipe.recv()
+            results.append(n*size/(time.perf_counter() - t)/1e6)
+            p.stop()
+        print("%40s %10s %10s %12.1f %12.1f" % ("AsyncBackMessageProcess, to frontend", capacity, granted, *results))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("please give 'duplex', 'dispatch', 'codec', 'call', 'pool', 'zygote', 'slab', 'mailbox', 'bus' or 'capacity'")
+    elif sys.argv[1] == "duplex":
+        benchDuplex(oob = False)
+        benchDuplex(oob = True)
+    elif sys.argv[1] == "dispatch":
+        benchDispatch()
+    elif sys.argv[1] == "codec":
+        checkCodec()
+        benchCodec()
+    elif sys.argv[1] == "call":
+        benchCall()
+    elif sys.argv[1] == "pool":
+        benchPool()
+    elif sys.argv[1] == "zygote":
+        if len(sys.argv) > 2:
+            benchZygote(modules = sys.argv[2:])
+        else:
+            benchZygote()
+    elif sys.argv[1] == "slab":
+        benchSlab()
+    elif sys.argv[1] == "mailbox":
+        benchMailbox()
+    elif sys.argv[1] == "bus":
+        benchBus()
+    elif sys.argv[1] == "capacity":
+        benchCapacity()
+    else:
+        print("please give 'duplex', 'dispatch', 'codec', 'call', 'pool', 'zygote', 'slab', 'mailbox', 'bus' or 'capacity'")
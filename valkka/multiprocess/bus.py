@@ -0,0 +1,377 @@
+"""bus.py : A shared memory broadcast bus for fanning out frames to many multiprocesses
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    bus.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   A shared memory broadcast bus for fanning out frames to many multiprocesses
+"""
+import math
+import time
+import threading
+import weakref
+from valkka.multiprocess.shmem import SharedArray
+from valkka.multiprocess.sync import FdEvent
+from valkka.multiprocess.ring import fence
+try:
+    import numpy as np
+except ImportError: # numpy is optional
+    np = None
+
+
+LINE = 64 # header, reader entries & slots start at cache line boundaries
+
+# uint64 indexes into the bus header
+WRITTEN = 0 # number of the latest published frame.  0 = nothing published yet
+WRITER_WAITING = 1 # writer is waiting for slow readers (policy "block")
+
+# uint64 indexes into a reader entry
+ACTIVE = 0
+CURSOR = 1 # number of the latest frame read
+
+# uint64 indexes into a slot header
+SEQ = 0 # seqlock: odd while the slot is being written
+FRAME = 1 # number of the frame in the slot
+
+
+buses = weakref.WeakValueDictionary() # all BroadcastBus instances of this python process, by name
+
+
+def getBus(name: str):
+    """Returns the ``BroadcastBus`` with the given name, or ``None`` if this python process has not got it
+    """
+    return buses.get(name)
+
+
+class BroadcastBus:
+    """A ring of frames in shared memory with one writer and many readers.  Each reader has its own cursor,
+    so every reader gets every frame, but a frame is written only once, whatever the number of readers.
+
+    :param shape: shape of a frame
+    :param dtype: numpy dtype of a frame
+    :param n_slots: number of frames in the ring
+    :param max_readers: maximum number of simultaneous readers
+    :param policy: what to do with a reader that is ``n_slots`` frames behind:
+
+        - ``"skip"``: the writer never waits.  The slow reader skips the frames that were overwritten
+        - ``"block"``: the writer waits in ``publish`` until the slowest reader has read the frame that is to be overwritten
+
+    :param track: see ``SharedArray``
+
+    Create in the frontend before starting the multiprocesses and give it to them, say, as a constructor argument, so that each one
+    of them has the bus.  Subscribe a multiprocess by sending a ``BusReader`` to it in a ``MessageObject``: only the name of the bus and the index
+    of the reader are transferred, the rest is looked up from the bus that the multiprocess has inherited:
+
+    ::
+
+        class AnalyzerProcess(MessageProcess):
+
+            def __init__(self, name, bus):
+                super().__init__(name)
+                self.bus = bus
+
+            def c__subscribe(self, reader=None):
+                self.reader__ = reader
+                self.frame__ = np.zeros(reader.bus.shape, reader.bus.dtype)
+                self.registerFd__(reader, self.onFrame__)
+
+            def onFrame__(self):
+                while self.reader__.read(self.frame__) is not None:
+                    ... # analyze self.frame__
+
+        bus = BroadcastBus((1080, 1920, 3), np.uint8, n_slots=8)
+        processes = [AnalyzerProcess("analyzer-%i" % i, bus) for i in range(4)]
+        ... # start the processes
+        for p in processes:
+            p.sendMessageToBack(MessageObject("subscribe", reader=bus.subscribe()))
+        ...
+        bus.publish(frame) # frontend
+
+    ``publish`` copies the frame once into shared memory and sets the ``FdEvent`` of each subscribed reader.
+    Relies on the hardware keeping the order of stores (as x86 does), like ``FrameMailbox``.
+    """
+    SKIP = "skip"
+    BLOCK = "block"
+
+    def __init__(self, shape, dtype = "uint8", n_slots = 8, max_readers = 8, policy = "skip", track = True):
+        if policy not in (self.SKIP, self.BLOCK):
+            raise ValueError("unknown policy %s" % (policy))
+        if n_slots < 3:
+            raise ValueError("n_slots must be at least 3")
+        if isinstance(shape, int):
+            shape = (shape,)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.nbytes = np.dtype(dtype).itemsize * math.prod(self.shape)
+        self.n_slots = n_slots
+        self.max_readers = max_readers
+        self.policy = policy
+        self.slot_size = LINE + (self.nbytes + LINE - 1) // LINE * LINE
+        self.shared = SharedArray(LINE * (1 + max_readers) + n_slots * self.slot_size, np.uint8, track = track)
+        self.name = self.shared.name
+        self.reader_events = [FdEvent() for i in range(max_readers)]
+        self.writer_event = FdEvent()
+        self.init__()
+
+    def init__(self):
+        buf = memoryview(self.shared.buf)
+        self.header = buf[0:LINE].cast("Q")
+        self.entries = [buf[LINE * (1 + i):LINE * (2 + i)].cast("Q") for i in range(self.max_readers)]
+        self.slot_headers = []
+        self.slot_arrays = []
+        for i in range(self.n_slots):
+            start = LINE * (1 + self.max_readers) + i * self.slot_size
+            self.slot_headers.append(buf[start:start + LINE].cast("Q"))
+            self.slot_arrays.append(np.frombuffer(
+                self.shared.buf, dtype = np.dtype(self.dtype), count = math.prod(self.shape), offset = start + LINE
+            ).reshape(self.shape))
+        self.readers = weakref.WeakValueDictionary() # BusReaders of this python process, by index
+        self.lock = threading.Lock()
+        self.n_blocked = 0
+        buses[self.name] = self
+
+    def __str__(self):
+        return "<BroadcastBus: %s %s %s %s>" % (self.name, self.shape, self.dtype, self.policy)
+
+    def __getstate__(self):
+        return {
+            "shape": self.shape,
+            "dtype": self.dtype,
+            "nbytes": self.nbytes,
+            "n_slots": self.n_slots,
+            "max_readers": self.max_readers,
+            "policy": self.policy,
+            "slot_size": self.slot_size,
+            "shared": self.shared,
+            "name": self.name,
+            "reader_events": self.reader_events,
+            "writer_event": self.writer_event
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init__()
+
+    def subscribe(self):
+        """Reserve a reader.  Returns a ``BusReader`` that starts from the next published frame.
+        Call in one process only, typically in the frontend that created the bus
+
+        Raises ``RuntimeError`` if there are already ``max_readers`` readers
+        """
+        with self.lock:
+            for i, entry in enumerate(self.entries):
+                if not entry[ACTIVE]:
+                    entry[CURSOR] = self.header[WRITTEN]
+                    self.reader_events[i].clear()
+                    fence()
+                    entry[ACTIVE] = 1
+                    return self.reader(i)
+        raise RuntimeError("BroadcastBus: all %i readers in use" % (self.max_readers))
+
+    def reader(self, index: int):
+        """The ``BusReader`` with the given index in this python process
+        """
+        reader = self.readers.get(index)
+        if reader is None:
+            reader = BusReader(self, index)
+            self.readers[index] = reader
+        return reader
+
+    def getSubscribers(self) -> int:
+        """Number of readers
+        """
+        return sum(1 for entry in self.entries if entry[ACTIVE])
+
+    def slowest__(self) -> int:
+        """Cursor of the slowest reader, or ``None`` if there are no readers
+        """
+        slowest = None
+        for entry in self.entries:
+            if entry[ACTIVE]:
+                cursor = entry[CURSOR]
+                if slowest is None or cursor < slowest:
+                    slowest = cursor
+        return slowest
+
+    def publish(self, frame, timeout = None) -> bool:
+        """Write a frame to all readers.  Call only in one process (the writer)
+
+        :param frame: numpy array (or anything numpy can copy from) with the bus shape
+        :param timeout: with policy "block", wait at most this many seconds for slow readers
+
+        Returns ``False`` if the frame was not published because of slow readers
+        """
+        n = self.header[WRITTEN] + 1
+        if self.policy == self.BLOCK:
+            slowest = self.slowest__()
+            if slowest is not None and slowest <= n - self.n_slots - 1:
+                if not self.waitReaders__(n, timeout):
+                    return False
+        slot = self.slot_headers[n % self.n_slots]
+        slot[SEQ] += 1 # odd: writing
+        fence()
+        slot[FRAME] = n
+        np.copyto(self.slot_arrays[n % self.n_slots], frame, casting = "unsafe")
+        fence()
+        slot[SEQ] += 1 # even: done
+        self.header[WRITTEN] = n
+        fence()
+        for i, entry in enumerate(self.entries):
+            if entry[ACTIVE]:
+                self.reader_events[i].set()
+        return True
+
+    def waitReaders__(self, n, timeout) -> bool:
+        """Wait until all readers have read frame n - n_slots, that is going to be overwritten by frame n
+        """
+        self.n_blocked += 1
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.writer_event.clear()
+            self.header[WRITER_WAITING] = 1
+            fence()
+            slowest = self.slowest__()
+            if slowest is None or slowest > n - self.n_slots - 1:
+                self.header[WRITER_WAITING] = 0
+                return True
+            if deadline is None:
+                self.writer_event.wait(None)
+            elif not self.writer_event.wait(max(deadline - time.monotonic(), 0)):
+                self.header[WRITER_WAITING] = 0
+                return False
+
+    def getStats(self) -> dict:
+        """Returns a dictionary with keys ``published``, ``subscribers``, ``blocked`` (number of times the writer waited)
+        and ``lag`` (list of the number of unread frames of each reader, ``None`` if the reader is not in use)
+        """
+        written = self.header[WRITTEN]
+        return {
+            "published": written,
+            "subscribers": self.getSubscribers(),
+            "blocked": self.n_blocked,
+            "lag": [written - entry[CURSOR] if entry[ACTIVE] else None for entry in self.entries]
+        }
+
+    def unlink(self):
+        """See ``SharedArray.unlink``
+        """
+        self.shared.unlink()
+
+
+class BusReader:
+    """A reader of a ``BroadcastBus``.  Get one with ``BroadcastBus.subscribe``
+
+    Pickled as the name of the bus and the index of the reader: the multiprocess that unpickles it must have the bus already
+    """
+    def __init__(self, bus: BroadcastBus, index: int):
+        self.bus = bus
+        self.index = index
+        self.event = bus.reader_events[index]
+        self.entry = bus.entries[index]
+        self.n_read = 0
+        self.n_skipped = 0
+
+    def __str__(self):
+        return "<BusReader: %s %i>" % (self.bus.name, self.index)
+
+    def __reduce__(self):
+        return (getBusReader, (self.bus.name, self.index))
+
+    def fileno(self):
+        """File descriptor that is readable when there are new frames
+        """
+        return self.event.fileno()
+
+    def read(self, out):
+        """Read the next frame
+
+        :param out: numpy array where the frame is copied into
+
+        Returns the frame number, or ``None`` if there is no new frame
+        """
+        if self.readFrame(out) is None:
+            return None
+        return self.entry[CURSOR]
+
+    def readFrame(self, out = None):
+        """Like ``read``, but returns the frame (a numpy array), or ``None`` if there is no new frame.
+        If ``out`` is ``None``, a new array is created
+        """
+        bus = self.bus
+        n_slots = bus.n_slots
+        while True:
+            written = bus.header[WRITTEN]
+            n = self.entry[CURSOR] + 1
+            if n > written:
+                self.event.clear()
+                if bus.header[WRITTEN] >= n: # published after we looked
+                    continue
+                return None
+            if bus.policy == bus.BLOCK:
+                oldest = written - n_slots + 1
+            else: # the slot after the latest frame might be being written at this moment
+                oldest = written - n_slots + 2
+            if n < oldest:
+                self.n_skipped += oldest - n
+                n = oldest
+            slot = bus.slot_headers[n % n_slots]
+            seq = slot[SEQ]
+            if seq & 1 or slot[FRAME] != n: # overwritten already: we are too slow
+                self.entry[CURSOR] = n
+                self.n_skipped += 1
+                continue
+            fence()
+            if out is None:
+                out_ = bus.slot_arrays[n % n_slots].copy()
+            else:
+                np.copyto(out, bus.slot_arrays[n % n_slots])
+                out_ = out
+            fence()
+            if slot[SEQ] != seq: # torn: overwritten while we were copying
+                self.entry[CURSOR] = n
+                self.n_skipped += 1
+                continue
+            self.entry[CURSOR] = n
+            self.n_read += 1
+            if bus.header[WRITER_WAITING]:
+                bus.writer_event.set()
+            return out_
+
+    def close(self):
+        """Unsubscribe.  Can be called in any process
+        """
+        self.entry[ACTIVE] = 0
+        if self.bus.header[WRITER_WAITING]:
+            self.bus.writer_event.set()
+
+    def getStats(self) -> dict:
+        """Returns a dictionary with keys ``read`` and ``skipped``, counted by this process
+        """
+        return {
+            "read": self.n_read,
+            "skipped": self.n_skipped
+        }
+
+
+def getBusReader(name, index):
+    bus = getBus(name)
+    if bus is None:
+        raise RuntimeError("BusReader: this process does not have the BroadcastBus %s" % (name))
+    return bus.reader(index)
@@ -0,0 +1,375 @@
+"""codec.py : Encoding of MessageObjects for the intercom between multiprocessing front- and backend
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    codec.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   Encoding of MessageObjects for the intercom between multiprocessing front- and backend
+
+All codecs produce self-describing payloads: a pickle (protocol 2 or higher) always starts with byte ``0x80``,
+while ``BinaryCodec`` payloads start with ``BINARY_MAGIC`` (or ``BINARY_MAGIC_CALL``, or ``BINARY_MAGIC_BATCH`` for a list of messages).  So ``decode`` of any codec understands
+the payloads of all of them.
+"""
+import struct
+import math
+import pickle
+from multiprocessing.reduction import ForkingPickler
+from valkka.multiprocess.shmem import ShmemArrayHandle, SlabBlock
+try:
+    import numpy as np
+except ImportError: # numpy is optional
+    np = None
+
+
+BINARY_MAGIC = 0xB7 # first byte of a BinaryCodec payload
+BINARY_MAGIC_CALL = 0xB8 # first byte of a BinaryCodec payload having a call id
+BINARY_MAGIC_BATCH = 0xB9 # first byte of a BinaryCodec payload having a list of messages
+
+# type tags of BinaryCodec
+T_NONE = 0
+T_TRUE = 1
+T_FALSE = 2
+T_INT = 3 # int64
+T_FLOAT = 4 # float64
+T_STR = 5
+T_BYTES = 6
+T_BYTEARRAY = 7
+T_LIST = 8
+T_TUPLE = 9
+T_ARRAY = 10 # numpy array: header + raw data
+T_SHMEM = 11 # ShmemArrayHandle: just the header
+T_SLAB = 12 # SlabBlock: segment, offset, length
+
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+
+s_tag = struct.Struct("<B")
+s_int = struct.Struct("<Bq")
+s_slab = struct.Struct("<BIqq")
+s_float = struct.Struct("<Bd")
+s_len = struct.Struct("<BI") # tag + length of str, bytes, list, etc.
+s_header = struct.Struct("<BBB") # magic, number of kwargs, length of the command (255 for an int command)
+s_q = struct.Struct("<q")
+s_I = struct.Struct("<I")
+s_B = struct.Struct("<B")
+unpack_q = s_q.unpack_from
+unpack_I = s_I.unpack_from
+unpack_d = struct.Struct("<d").unpack_from
+
+TAGS = [s_tag.pack(i) for i in range(13)]
+
+
+class NotEncodable(Exception):
+    """Raised internally by ``BinaryCodec`` when it has to fall back to pickle
+    """
+    pass
+
+
+class PickleCodec:
+    """Pickles the object, like ``multiprocessing.Connection.send`` does.  Can encode anything picklable.
+
+    ``decode`` understands also the payloads of ``BinaryCodec``
+    """
+    name = "pickle"
+
+    def encode(self, obj) -> bytes:
+        return ForkingPickler.dumps(obj)
+
+    def encodeMany(self, objs) -> bytes:
+        """Encode a list of objects into a single payload.  ``decode`` returns the list
+        """
+        return ForkingPickler.dumps(list(objs))
+
+    def decode(self, b):
+        if b[0] == BINARY_MAGIC or b[0] == BINARY_MAGIC_CALL:
+            return binaryDecode(b)
+        if b[0] == BINARY_MAGIC_BATCH:
+            return batchDecode(b)
+        return pickle.loads(b)
+
+
+class BinaryCodec(PickleCodec):
+    """Compact binary encoding for ``MessageObject`` s having the common payload:
+
+    - a str (or an integer opcode) command
+    - kwargs whose values are ``None``, bool, int (64 bit), float, str, bytes, bytearray,
+      (small) lists and tuples of these, numpy arrays, ``ShmemArrayHandle`` s and ``SlabBlock`` s
+
+    Anything else is pickled, as are strs that are not valid unicode and zero-size, datetime64 and timedelta64 arrays.
+
+    :param message_class: the ``MessageObject`` class
+
+    Layout of a payload (little-endian):
+
+    ::
+
+        1 byte: BINARY_MAGIC, or BINARY_MAGIC_CALL if the message has a call id
+        1 byte: number of kwargs
+        1 byte: length of the (utf-8) command, or 255 if the command is an int64 that follows
+        8 bytes: call id (only with BINARY_MAGIC_CALL)
+        command
+        for each kwarg: 1 byte length of the key, key, value
+
+    where each value is a tag byte followed by its data.
+
+    ``encodeMany`` encodes a list of messages, each one as above (or pickled):
+
+    ::
+
+        1 byte: BINARY_MAGIC_BATCH
+        4 bytes: number of messages
+        for each message: 4 bytes length, payload
+    """
+    name = "binary"
+
+    def __init__(self, message_class):
+        self.message_class = message_class
+
+    def encode(self, obj) -> bytes:
+        if obj.__class__ is not self.message_class or len(obj.kwargs) > 255:
+            return ForkingPickler.dumps(obj)
+        try:
+            command = obj.command
+            if command.__class__ is str:
+                c = encodeStr(command)
+                if len(c) >= 255:
+                    raise NotEncodable
+                n_command = len(c)
+            elif command.__class__ is int and INT_MIN <= command <= INT_MAX:
+                c = s_q.pack(command)
+                n_command = 255
+            else:
+                raise NotEncodable
+            if obj.call_id is None:
+                parts = [s_header.pack(BINARY_MAGIC, len(obj.kwargs), n_command), c]
+            else:
+                parts = [s_header.pack(BINARY_MAGIC_CALL, len(obj.kwargs), n_command), s_q.pack(obj.call_id), c]
+            for key, value in obj.kwargs.items():
+                k = encodeStr(key)
+                if len(k) > 255:
+                    raise NotEncodable
+                parts.append(s_B.pack(len(k)))
+                parts.append(k)
+                encodeValue(value, parts)
+        except NotEncodable:
+            return ForkingPickler.dumps(obj)
+        return b"".join(parts)
+
+    def encodeMany(self, objs) -> bytes:
+        payloads = [self.encode(obj) for obj in objs]
+        parts = [s_len.pack(BINARY_MAGIC_BATCH, len(payloads))]
+        for payload in payloads:
+            parts.append(s_I.pack(len(payload)))
+            parts.append(payload)
+        return b"".join(parts)
+
+    def decode(self, b):
+        if b[0] == BINARY_MAGIC or b[0] == BINARY_MAGIC_CALL:
+            return binaryDecode(b, self.message_class)
+        if b[0] == BINARY_MAGIC_BATCH:
+            return batchDecode(b, self.message_class)
+        return pickle.loads(b)
+
+
+def batchDecode(b, message_class = None) -> list:
+    """Decode a ``BinaryCodec.encodeMany`` payload into a list of ``MessageObject`` s (or whatever was pickled)
+    """
+    if message_class is None:
+        from valkka.multiprocess.base import MessageObject as message_class
+    if b.__class__ is not bytes:
+        b = bytes(b)
+    n_messages = unpack_I(b, 1)[0]
+    i = 5
+    objs = []
+    for j in range(n_messages):
+        n = i + 4 + unpack_I(b, i)[0]
+        if b[i + 4] == BINARY_MAGIC or b[i + 4] == BINARY_MAGIC_CALL:
+            objs.append(binaryDecode(b, message_class, i + 4)) # no need to slice
+        else:
+            objs.append(pickle.loads(memoryview(b)[i + 4:n]))
+        i = n
+    return objs
+
+
+def encodeStr(s) -> bytes:
+    """utf-8 encoding of s.  A str that is not valid unicode (say, having lone surrogates) is pickled instead
+    """
+    try:
+        return s.encode("utf-8")
+    except UnicodeEncodeError:
+        raise NotEncodable
+
+
+def encodeValue(value, parts):
+    """Append the binary encoding of value into a list of bytes
+    """
+    cls = value.__class__
+    if cls is int:
+        if not INT_MIN <= value <= INT_MAX:
+            raise NotEncodable
+        parts.append(s_int.pack(T_INT, value))
+    elif cls is float:
+        parts.append(s_float.pack(T_FLOAT, value))
+    elif cls is str:
+        s = encodeStr(value)
+        parts.append(s_len.pack(T_STR, len(s)))
+        parts.append(s)
+    elif value is None:
+        parts.append(TAGS[T_NONE])
+    elif value is True:
+        parts.append(TAGS[T_TRUE])
+    elif value is False:
+        parts.append(TAGS[T_FALSE])
+    elif cls is bytes or cls is bytearray:
+        parts.append(s_len.pack(T_BYTES if cls is bytes else T_BYTEARRAY, len(value)))
+        parts.append(value)
+    elif cls is list or cls is tuple:
+        parts.append(s_len.pack(T_LIST if cls is list else T_TUPLE, len(value)))
+        for v in value:
+            encodeValue(v, parts)
+    elif np is not None and cls is np.ndarray:
+        if value.dtype.hasobject or value.dtype.fields is not None or value.dtype.kind in "mM" or value.size == 0:
+            raise NotEncodable # no buffer interface for datetimes and zero-size arrays
+        encodeArrayHeader(T_ARRAY, value.dtype.str, value.shape, parts)
+        if value.flags.c_contiguous:
+            parts.append(memoryview(value).cast("B"))
+        else:
+            parts.append(value.tobytes())
+    elif cls is SlabBlock:
+        parts.append(s_slab.pack(T_SLAB, value.segment, value.offset, value.length))
+    elif cls is ShmemArrayHandle:
+        encodeArrayHeader(T_SHMEM, value.dtype, value.shape, parts)
+        name = value.name.encode("utf-8")
+        parts.append(s_B.pack(len(name)))
+        parts.append(name)
+    else:
+        raise NotEncodable
+
+
+def encodeArrayHeader(tag, dtype, shape, parts):
+    """dtype string and shape
+    """
+    d = dtype.encode("ascii")
+    parts.append(bytes((tag, len(d))))
+    parts.append(d)
+    parts.append(s_B.pack(len(shape)))
+    parts.append(struct.pack("<%iq" % len(shape), *shape))
+
+
+def binaryDecode(b, message_class = None, start = 0):
+    """Decode a ``BinaryCodec`` payload, starting at index start of b, into a ``MessageObject``
+    """
+    if message_class is None:
+        from valkka.multiprocess.base import MessageObject as message_class
+    if b.__class__ is not bytes: # slicing bytes is faster than slicing a memoryview
+        b = bytes(b)
+    n_kwargs = b[start + 1]
+    n_command = b[start + 2]
+    i = start + 3
+    call_id = None
+    if b[start] == BINARY_MAGIC_CALL:
+        call_id = unpack_q(b, i)[0]
+        i += 8
+    if n_command == 255:
+        command = unpack_q(b, i)[0]
+        i += 8
+    else:
+        command = b[i:i + n_command].decode("utf-8")
+        i += n_command
+    kwargs = {}
+    for j in range(n_kwargs):
+        n = b[i] + i + 1
+        key = b[i + 1:n].decode("utf-8")
+        # inlined scalars: this is the hot path
+        tag = b[n]
+        if tag == T_INT:
+            kwargs[key] = unpack_q(b, n + 1)[0]
+            i = n + 9
+        elif tag == T_FLOAT:
+            kwargs[key] = unpack_d(b, n + 1)[0]
+            i = n + 9
+        elif tag == T_STR:
+            i = n + 5 + unpack_I(b, n + 1)[0]
+            kwargs[key] = b[n + 5:i].decode("utf-8")
+        else:
+            kwargs[key], i = decodeValue(b, n)
+    obj = message_class.__new__(message_class)
+    obj.command = command
+    obj.kwargs = kwargs
+    obj.call_id = call_id
+    return obj
+
+
+def decodeValue(b, i):
+    """Returns the value starting at index i of bytes b and the index of the next value
+    """
+    tag = b[i]
+    if tag == T_INT:
+        return unpack_q(b, i + 1)[0], i + 9
+    elif tag == T_FLOAT:
+        return unpack_d(b, i + 1)[0], i + 9
+    elif tag == T_STR:
+        n = i + 5 + unpack_I(b, i + 1)[0]
+        return b[i + 5:n].decode("utf-8"), n
+    elif tag == T_NONE:
+        return None, i + 1
+    elif tag == T_TRUE:
+        return True, i + 1
+    elif tag == T_FALSE:
+        return False, i + 1
+    elif tag == T_BYTES or tag == T_BYTEARRAY:
+        n = i + 5 + unpack_I(b, i + 1)[0]
+        if tag == T_BYTES:
+            return b[i + 5:n], n
+        return bytearray(b[i + 5:n]), n
+    elif tag == T_LIST or tag == T_TUPLE:
+        n = unpack_I(b, i + 1)[0]
+        i += 5
+        lis = []
+        for j in range(n):
+            value, i = decodeValue(b, i)
+            lis.append(value)
+        if tag == T_TUPLE:
+            return tuple(lis), i
+        return lis, i
+    elif tag == T_SLAB:
+        tag, segment, offset, length = s_slab.unpack_from(b, i)
+        return SlabBlock(segment, offset, length), i + s_slab.size
+    elif tag == T_ARRAY or tag == T_SHMEM:
+        n = b[i + 1]
+        dtype = b[i + 2:i + 2 + n].decode("ascii")
+        i += 2 + n
+        ndim = b[i]
+        shape = struct.unpack_from("<%iq" % ndim, b, i + 1)
+        i += 1 + 8*ndim
+        if tag == T_SHMEM:
+            n = b[i]
+            handle = ShmemArrayHandle.__new__(ShmemArrayHandle)
+            handle.name = b[i + 1:i + 1 + n].decode("utf-8")
+            handle.shape = shape
+            handle.dtype = dtype
+            handle.nbytes = np.dtype(dtype).itemsize * math.prod(shape)
+            return handle, i + 1 + n
+        dt = np.dtype(dtype)
+        count = math.prod(shape)
+        # copy, so that the array is writable, like with pickle
+        array = np.frombuffer(b, dtype = dt, count = count, offset = i).reshape(shape).copy()
+        return array, i + count * dt.itemsize
+    raise ValueError("BinaryCodec: unknown tag %i" % tag)
@@ -0,0 +1,224 @@
+"""mailbox.py : A shared memory mailbox that always holds the latest frame
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    mailbox.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   A shared memory mailbox that always holds the latest frame
+"""
+import math
+from valkka.multiprocess.shmem import SharedArray
+from valkka.multiprocess.sync import FdEvent
+from valkka.multiprocess.ring import fence
+try:
+    import numpy as np
+except ImportError: # numpy is optional
+    np = None
+
+
+N_SLOTS = 3
+LINE = 64 # header & slots start at cache line boundaries
+
+# uint64 indexes into the mailbox header
+LATEST = 0 # number of the latest complete frame.  0 = nothing written yet
+
+# uint64 indexes into a slot header
+SEQ = 0 # seqlock: odd while the slot is being written
+FRAME = 1 # number of the frame in the slot
+
+
+class FrameMailbox:
+    """A "latest value" channel in shared memory: one writer, any number of readers.  The writer never waits
+    and a reader always gets the most recent complete frame, skipping the frames it was too slow to read.
+
+    :param shape: shape of a frame
+    :param dtype: numpy dtype of a frame
+    :param notify: if ``True``, the writer sets an ``FdEvent`` for each frame, so that a reader can wait for frames
+                   with ``select``, ``registerFd__`` or asyncio.  Use then only one reader
+    :param track: see ``SharedArray``
+
+    Frames are written in turns into three slots.  Each slot has a sequence counter that is odd while the slot is being
+    written: a reader copies the frame out and compares the counter before and after the copy, so a frame that was
+    overwritten while being copied (a torn read) is detected and the read is retried.
+
+    Create in the frontend, like a ``SharedArray``, and use it in the front- and/or backend.  Say, a backend analyzer gets
+    frames from the frontend at its own pace:
+
+    ::
+
+        class AnalyzerProcess(MessageProcess):
+
+            def __init__(self, name):
+                super().__init__(name)
+                self.mailbox = FrameMailbox((1080, 1920, 3), np.uint8, notify=True)
+
+            def preRun__(self):
+                self.frame__ = np.zeros((1080, 1920, 3), np.uint8)
+                self.registerFd__(self.mailbox, self.onFrame__)
+
+            def onFrame__(self):
+                if self.mailbox.read(out=self.frame__) is not None:
+                    ... # analyze self.frame__
+
+        # frontend
+        p.mailbox.write(frame) # never blocks, whatever the analyzer is doing
+
+    ``AnalyzerProcess`` in ``valkka.multiprocess.benchmark`` is a working version of this.
+
+    Relies on the hardware keeping the order of stores (as x86 does): the header is written after the frame data.
+    """
+    def __init__(self, shape, dtype = "uint8", notify = False, track = True):
+        if isinstance(shape, int):
+            shape = (shape,)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.nbytes = np.dtype(dtype).itemsize * math.prod(self.shape)
+        self.slot_size = LINE + (self.nbytes + LINE - 1) // LINE * LINE
+        self.shared = SharedArray(LINE + N_SLOTS * self.slot_size, np.uint8, track = track)
+        self.event = FdEvent() if notify else None
+        self.init__()
+
+    def init__(self):
+        buf = memoryview(self.shared.buf)
+        self.header = buf[0:LINE].cast("Q")
+        self.slot_headers = []
+        self.slot_arrays = []
+        for i in range(N_SLOTS):
+            start = LINE + i * self.slot_size
+            self.slot_headers.append(buf[start:start + LINE].cast("Q"))
+            self.slot_arrays.append(np.frombuffer(
+                self.shared.buf, dtype = np.dtype(self.dtype), count = math.prod(self.shape), offset = start + LINE
+            ).reshape(self.shape))
+        self.written = 0 # frames written by this process
+        self.last_read = 0 # number of the latest frame read by this process
+        self.n_read = 0
+        self.n_skipped = 0
+        self.n_torn = 0
+
+    def __str__(self):
+        return "<FrameMailbox: %s %s %s>" % (self.shared.name, self.shape, self.dtype)
+
+    def __getstate__(self):
+        return {
+            "shape": self.shape,
+            "dtype": self.dtype,
+            "nbytes": self.nbytes,
+            "slot_size": self.slot_size,
+            "shared": self.shared,
+            "event": self.event
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init__()
+
+    def fileno(self):
+        """File descriptor that is readable when there is a new frame.  Only with ``notify=True``
+        """
+        return self.event.fileno()
+
+    def write(self, frame):
+        """Write a new frame.  Never blocks.  Call only in one process (the writer)
+
+        :param frame: numpy array (or anything numpy can copy from) with the mailbox shape
+        """
+        n = max(self.written, self.header[LATEST]) + 1 # continue the numbering if the writer process changes
+        slot = self.slot_headers[n % N_SLOTS]
+        slot[SEQ] += 1 # odd: writing
+        fence()
+        slot[FRAME] = n
+        np.copyto(self.slot_arrays[n % N_SLOTS], frame, casting = "unsafe")
+        fence()
+        slot[SEQ] += 1 # even: done
+        self.header[LATEST] = n
+        self.written = n
+        if self.event is not None:
+            self.event.set()
+
+    def read(self, out):
+        """Read the latest frame, if it's newer than the one read previously
+
+        :param out: numpy array where the frame is copied into
+
+        Returns the frame number, or ``None`` if there is no new frame
+        """
+        frame = self.readFrame(out)
+        if frame is None:
+            return None
+        return self.last_read
+
+    def readFrame(self, out = None):
+        """Like ``read``, but returns the frame (a numpy array), or ``None`` if there is no new frame.
+        If ``out`` is ``None``, a new array is created
+        """
+        if self.event is not None:
+            self.event.clear() # before reading, so that a frame written after this sets the event again
+        while True:
+            n = self.header[LATEST]
+            if n == self.last_read:
+                return None
+            slot = self.slot_headers[n % N_SLOTS]
+            seq = slot[SEQ]
+            if seq & 1 or slot[FRAME] != n: # being rewritten already
+                self.n_torn += 1
+                continue
+            fence()
+            if out is None:
+                out = self.slot_arrays[n % N_SLOTS].copy()
+            else:
+                np.copyto(out, self.slot_arrays[n % N_SLOTS])
+            fence()
+            if slot[SEQ] != seq: # torn: the writer went round all the slots while we were copying
+                self.n_torn += 1
+                continue
+            self.n_skipped += max(n - self.last_read - 1, 0)
+            self.n_read += 1
+            self.last_read = n
+            return out
+
+    def wait(self, timeout = None) -> bool:
+        """Wait for a new frame.  Only with ``notify=True``.  Returns ``False`` if timed out
+        """
+        if self.header[LATEST] != self.last_read:
+            return True
+        return self.event.wait(timeout)
+
+    async def waitAsync(self):
+        """Wait in asyncio for a new frame.  Only with ``notify=True``
+        """
+        if self.header[LATEST] != self.last_read:
+            return
+        await self.event.waitAsync()
+
+    def getStats(self) -> dict:
+        """Returns a dictionary with keys ``latest`` (number of the latest frame written), ``read``, ``skipped`` and ``torn``
+        (number of retried reads), counted by this process
+        """
+        return {
+            "latest": self.header[LATEST],
+            "read": self.n_read,
+            "skipped": self.n_skipped,
+            "torn": self.n_torn
+        }
+
+    def unlink(self):
+        """See ``SharedArray.unlink``
+        """
+        self.shared.unlink()
@@ -0,0 +1,242 @@
+"""pool.py : A pool of multiprocesses with load-balanced dispatch
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    pool.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   A pool of multiprocesses with load-balanced dispatch
+"""
+import time
+import threading
+import logging
+from collections import deque
+from concurrent.futures import Future
+from valkka.multiprocess.base import MessageProcess, MessageObject, stopProcesses
+
+
+class MessageProcessPool:
+    """Starts ``n`` instances of a ``MessageProcess`` subclass and dispatches calls to them
+
+    :param process_class: a ``MessageProcess`` subclass.  Instantiated with ``name = "name-i"`` and ``**kwargs``
+    :param n: number of multiprocesses
+    :param policy: how a multiprocess is chosen for each call:
+
+        - ``"round-robin"``: in turns
+        - ``"least-outstanding"``: the one with the least calls in flight
+        - ``"first-idle"``: the first one with no calls in flight.  If all are busy, calls are queued in the pool until one gets idle
+
+    :param name: name of the pool
+    :param zygote: if not ``None``, a ``Zygote`` that is used to start the multiprocesses
+
+    Calls are done with ``MessageProcess.call``, so the backend methods return values to the frontend:
+
+    ::
+
+        pool = MessageProcessPool(WorkerProcess, n = 4, policy = "least-outstanding")
+        pool.start()
+        futures = [pool.call("doWork", x = i) for i in range(100)]
+        results = [future.result() for future in futures]
+        print(pool.getStats())
+        pool.stop()
+    """
+    ROUND_ROBIN = "round-robin"
+    LEAST_OUTSTANDING = "least-outstanding"
+    FIRST_IDLE = "first-idle"
+
+    def __init__(self, process_class, n = 4, policy = "round-robin", name = "pool", zygote = None, **kwargs):
+        if policy not in (self.ROUND_ROBIN, self.LEAST_OUTSTANDING, self.FIRST_IDLE):
+            raise ValueError("unknown policy %s" % (policy))
+        self.name = name
+        self.pre = self.__class__.__name__ + "." + self.name
+        self.logger = logging.getLogger(self.pre)
+        self.policy = policy
+        self.zygote = zygote
+        self.processes = [process_class(name = "%s-%i" % (name, i), **kwargs) for i in range(n)]
+        self.in_flight = [0] * n # calls in flight, per multiprocess
+        self.pending = deque() # (command, kwargs, future) waiting for an idle multiprocess
+        self.next_index = 0
+        self.completed = 0
+        self.t_start = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "<MessageProcessPool: %s: %s: %i>" % (self.name, self.policy, len(self.processes))
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __iter__(self):
+        return iter(self.processes)
+
+    def __getitem__(self, i) -> MessageProcess:
+        return self.processes[i]
+
+    def ignoreSIGINT(self):
+        """Call before ``start``, so that the multiprocesses ignore SIGINT
+        """
+        for p in self.processes:
+            p.ignoreSIGINT()
+
+    def start(self):
+        """Start all multiprocesses
+        """
+        for p in self.processes:
+            if self.zygote is None:
+                p.start()
+            else:
+                self.zygote.start(p)
+        self.t_start = time.monotonic()
+
+    def requestStop(self):
+        """Request all multiprocesses to stop.  Calls still waiting in the pool are cancelled
+        """
+        with self.lock:
+            pending = list(self.pending)
+            self.pending.clear()
+        for command, kwargs, future in pending:
+            future.cancel()
+        for p in self.processes:
+            p.requestStop()
+
+    def waitStop(self):
+        for p in self.processes:
+            p.waitStop()
+
+    def stop(self, timeout = None):
+        """Stop all multiprocesses in parallel and wait until they have finished
+
+        :param timeout: if not ``None``, wait at most this many seconds before terminating the multiprocesses.
+                        Returns then the report of ``stopProcesses``
+        """
+        if timeout is not None:
+            with self.lock:
+                pending = list(self.pending)
+                self.pending.clear()
+            for command, kwargs, future in pending:
+                future.cancel()
+            return stopProcesses(self.processes, timeout = timeout)
+        self.requestStop()
+        self.waitStop()
+
+    def pick__(self):
+        """Index of the multiprocess for the next call, or ``None`` if there is no idle multiprocess (for policy "first-idle").
+        Call with the lock held
+        """
+        n = len(self.processes)
+        if self.policy == self.ROUND_ROBIN:
+            i = self.next_index
+            self.next_index = (i + 1) % n
+            return i
+        if self.policy == self.LEAST_OUTSTANDING:
+            # start from a rotating index, so that ties are spread evenly
+            start = self.next_index
+            self.next_index = (start + 1) % n
+            best = start
+            for j in range(1, n):
+                i = (start + j) % n
+                if self.in_flight[i] < self.in_flight[best]:
+                    best = i
+            return best
+        for i in range(n): # first idle
+            if self.in_flight[i] == 0:
+                return i
+        return None
+
+    def call(self, command, **kwargs) -> Future:
+        """Call backend method ``c__command`` in one of the multiprocesses, chosen by the policy.  Returns a ``concurrent.futures.Future``
+        """
+        with self.lock:
+            i = self.pick__()
+            if i is None:
+                future = Future()
+                self.pending.append((command, kwargs, future))
+                return future
+            self.in_flight[i] += 1
+        return self.dispatch__(i, command, kwargs)
+
+    def dispatch__(self, i, command, kwargs) -> Future:
+        future = self.processes[i].call(command, **kwargs)
+        future.add_done_callback(lambda f: self.done__(i))
+        return future
+
+    def done__(self, i):
+        """A call to multiprocess i has finished: in the thread that reads the results of that multiprocess
+        """
+        with self.lock:
+            self.in_flight[i] -= 1
+            self.completed += 1
+        if self.pending:
+            self.dispatchPending__(i)
+
+    def dispatchPending__(self, i):
+        """Give a call waiting in the pool to multiprocess i, if it is idle
+        """
+        while True:
+            with self.lock:
+                if not self.pending or self.in_flight[i] > 0:
+                    return
+                command, kwargs, future = self.pending.popleft()
+                self.in_flight[i] += 1
+            if future.set_running_or_notify_cancel():
+                self.dispatch__(i, command, kwargs).add_done_callback(lambda f: copyFuture(f, future))
+                return
+            with self.lock: # the waiting call was cancelled: take the next one
+                self.in_flight[i] -= 1
+
+    def broadcast(self, message: MessageObject):
+        """Send a ``MessageObject`` to all multiprocesses
+        """
+        for p in self.processes:
+            p.sendMessageToBack(message)
+
+    def getInFlight(self) -> list:
+        """Number of calls in flight, per multiprocess
+        """
+        with self.lock:
+            return list(self.in_flight)
+
+    def getThroughput(self) -> float:
+        """Finished calls per second, pool-wide, since ``start``
+        """
+        if self.t_start is None:
+            return 0.0
+        return self.completed / max(time.monotonic() - self.t_start, 1e-9)
+
+    def getStats(self) -> dict:
+        """Returns a dictionary with keys ``completed``, ``in_flight`` (list), ``pending`` and ``throughput`` (calls per second)
+        """
+        with self.lock:
+            return {
+                "completed": self.completed,
+                "in_flight": list(self.in_flight),
+                "pending": len(self.pending),
+                "throughput": self.getThroughput()
+            }
+
+
+def copyFuture(source: Future, target: Future):
+    """Copy the result (or the exception) of a finished future into another one
+    """
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -0,0 +1,446 @@
+"""ring.py : A shared memory ring buffer transport between multiprocessing front- and backend
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    ring.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   A shared memory ring buffer transport between multiprocessing front- and backend
+"""
+import os
+import select
+import errno
+import pickle
+import threading
+from multiprocessing import shared_memory
+from multiprocessing.reduction import DupFd
+
+
+# counters live in separate cache lines so that producer & consumer don't
+# fight over the same line
+HEAD = 0            # total number of bytes written (index into the Q-cast header)
+TAIL = 8            # total number of bytes read
+WRITER_WAITING = 16 # producer is waiting for free space
+HEADER_SIZE = 192
+
+
+class Wakeup:
+    """A file descriptor that can be used as a wakeup signal between processes
+
+    Uses ``eventfd`` if available, otherwise a non-blocking ``os.pipe``.  Must be created
+    before forking.
+    """
+    def __init__(self):
+        if hasattr(os, "eventfd"):
+            self.read_fd = os.eventfd(0, os.EFD_NONBLOCK)
+            self.write_fd = self.read_fd
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+            os.set_blocking(self.write_fd, False)
+
+    def fileno(self):
+        return self.read_fd
+
+    def signal(self):
+        """Make the file descriptor readable
+        """
+        try:
+            if self.read_fd == self.write_fd:
+                os.eventfd_write(self.write_fd, 1)
+            else:
+                os.write(self.write_fd, b"x")
+        except BlockingIOError: # already signalled enough
+            pass
+
+    def drain(self):
+        """Consume all pending signals: file descriptor is not readable after this
+        """
+        try:
+            if self.read_fd == self.write_fd:
+                os.eventfd_read(self.read_fd)
+            else:
+                while os.read(self.read_fd, 4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout):
+        """Wait until signalled or timeout.  Does not consume the signal.
+        """
+        try:
+            r, w, e = select.select([self.read_fd], [], [], timeout)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+            return False
+        return len(r) > 0
+
+    def close(self):
+        os.close(self.read_fd)
+        if self.write_fd != self.read_fd:
+            os.close(self.write_fd)
+
+    def __reduce__(self):
+        # when the process is started with a fork server (see zygote.py), the file descriptors are sent to it
+        if self.write_fd == self.read_fd:
+            return (rebuildWakeup, (DupFd(self.read_fd), None))
+        return (rebuildWakeup, (DupFd(self.read_fd), DupFd(self.write_fd)))
+
+
+def rebuildWakeup(read_df, write_df):
+    wakeup = Wakeup.__new__(Wakeup)
+    wakeup.read_fd = read_df.detach()
+    wakeup.write_fd = wakeup.read_fd if write_df is None else write_df.detach()
+    return wakeup
+
+
+fence_lock = threading.Lock()
+
+def fence():
+    """Full memory barrier, poor man's version: acquiring & releasing a lock
+    goes through atomic instructions
+    """
+    fence_lock.acquire()
+    fence_lock.release()
+
+def reinitFence():
+    global fence_lock
+    fence_lock = threading.Lock() # in case some thread had it at the moment of fork
+
+os.register_at_fork(after_in_child = reinitFence)
+
+
+class RingBuffer:
+    """A single-producer / single-consumer byte ring buffer in ``multiprocessing.shared_memory``
+
+    :param size: capacity of the ring buffer in bytes
+
+    Must be created before forking.  The producer writes with ``writev``, the consumer
+    reads with ``readinto``.  Two wakeup file descriptors are used *only* when one of
+    the parties is idle:
+
+    - ``data`` is readable whenever there are unread bytes in the ring (it's signalled
+      by the producer when the ring goes from empty to non-empty)
+    - ``space`` is signalled by the consumer when the producer is waiting for free space
+
+    The producer publishes the data by writing ``HEAD`` after the data, and the consumer releases the space by writing
+    ``TAIL`` after copying the data out.  ``fence`` is called between the data and the counters at both sides, so the
+    ordering doesn't rely on the hardware keeping the order of stores and loads.
+
+    The segment is unlinked by the backend once it has started (see ``RingDuplex.unlink``), or when the frontend's
+    ``RingBuffer`` is garbage collected, say, if the process was never started.
+    """
+    def __init__(self, size = 1024*1024):
+        self.size = size
+        self.shmem = shared_memory.SharedMemory(create = True, size = HEADER_SIZE + size)
+        self.owner_pid = os.getpid() # a forked process inherits this object, but is not the owner
+        self.header = self.shmem.buf[0:HEADER_SIZE].cast("Q")
+        self.buf = self.shmem.buf[HEADER_SIZE:HEADER_SIZE + size]
+        self.header[HEAD] = 0
+        self.header[TAIL] = 0
+        self.header[WRITER_WAITING] = 0
+        self.data = Wakeup()
+        self.space = Wakeup()
+        self.unlinked = False
+
+    def __del__(self):
+        if self.owner_pid == os.getpid():
+            self.unlink()
+        self.header.release()
+        self.buf.release()
+        self.shmem.close()
+        self.data.close()
+        self.space.close()
+
+    def __reduce__(self):
+        # when the process is started with a fork server (see zygote.py), the segment is mapped by its name
+        return (attachRingBuffer, (self.shmem.name, self.size, self.data, self.space))
+
+    def unlink(self):
+        """Remove the shared memory segment name from the system.  Processes
+        that have already mapped the segment (say, a forked backend) can continue using it
+        """
+        if not self.unlinked:
+            self.unlinked = True
+            try:
+                self.shmem.unlink()
+            except FileNotFoundError: # unlinked already by the other process
+                pass
+
+    def used(self):
+        return self.header[HEAD] - self.header[TAIL]
+
+    def free(self):
+        return self.size - self.used()
+
+    def writev(self, buffers) -> int:
+        """Producer: copy as many bytes from the list of buffers as fits into the ring.
+
+        Returns number of bytes written.
+        """
+        head = self.header[HEAD]
+        n_free = self.size - (head - self.header[TAIL])
+        pos = head
+        for buf in buffers:
+            if n_free <= 0:
+                break
+            mv = memoryview(buf).cast("B")
+            n = min(len(mv), n_free)
+            i = pos % self.size
+            first = min(n, self.size - i)
+            self.buf[i:i + first] = mv[0:first]
+            if first < n:
+                self.buf[0:n - first] = mv[first:n]
+            pos += n
+            n_free -= n
+        if pos == head:
+            return 0
+        fence() # data must be visible before the head is
+        self.header[HEAD] = pos
+        fence()
+        if self.header[TAIL] == head: # consumer has eaten everything: it's idle or about to be
+            self.data.signal()
+        return pos - head
+
+    def readinto(self, mv) -> int:
+        """Consumer: copy bytes from the ring into the memoryview.
+
+        Returns number of bytes read.
+        """
+        tail = self.header[TAIL]
+        n = min(self.header[HEAD] - tail, len(mv))
+        if n <= 0:
+            return 0
+        fence() # read the head before the data
+        i = tail % self.size
+        first = min(n, self.size - i)
+        mv[0:first] = self.buf[i:i + first]
+        if first < n:
+            mv[first:n] = self.buf[0:n - first]
+        self.consumed__(tail + n)
+        return n
+
+    def copyOut__(self, pos, n):
+        i = pos % self.size
+        if i + n <= self.size:
+            return self.buf[i:i + n].tobytes()
+        return self.buf[i:].tobytes() + self.buf[0:n - (self.size - i)].tobytes()
+
+    def consumed__(self, tail):
+        fence() # data must be copied out before the producer sees the space
+        self.header[TAIL] = tail
+        fence()
+        if self.header[HEAD] == tail:
+            # ring is empty: clear the data signal, but re-arm it if
+            # the producer managed to write something meanwhile
+            self.data.drain()
+            if self.used() > 0:
+                self.data.signal()
+        if self.header[WRITER_WAITING]:
+            self.header[WRITER_WAITING] = 0
+            self.space.signal()
+
+    def writeFrame(self, b) -> bool:
+        """Producer: write 8 bytes of length + bytes-like object ``b`` into the ring in one go.
+
+        Returns ``False`` (and writes nothing) if there's not enough free space.
+        """
+        n = len(b)
+        head = self.header[HEAD]
+        if self.size - (head - self.header[TAIL]) < n + 8:
+            return False
+        i = head % self.size
+        if i + n + 8 <= self.size: # the usual case: no wrap-around
+            self.buf[i:i + 8] = n.to_bytes(8, byteorder = "big")
+            self.buf[i + 8:i + 8 + n] = b
+        else:
+            return self.writev([n.to_bytes(8, byteorder = "big"), b]) > 0
+        fence()
+        self.header[HEAD] = head + n + 8
+        fence()
+        if self.header[TAIL] == head:
+            self.data.signal()
+        return True
+
+    def readFrame(self):
+        """Consumer: read a complete frame written by ``writeFrame``.
+
+        Returns the payload as bytes or ``None`` if there is no complete frame in the ring.
+        """
+        tail = self.header[TAIL]
+        used = self.header[HEAD] - tail
+        if used < 8:
+            return None
+        fence() # read the head before the data
+        n = int.from_bytes(self.copyOut__(tail, 8), byteorder = "big")
+        if used < n + 8:
+            return None
+        b = self.copyOut__(tail + 8, n)
+        self.consumed__(tail + n + 8)
+        return b
+
+    def waitSpace(self, timeout):
+        """Producer: wait until there is free space in the ring
+        """
+        self.header[WRITER_WAITING] = 1
+        fence()
+        if self.free() > 0:
+            self.header[WRITER_WAITING] = 0
+            return
+        self.space.wait(timeout)
+        self.space.drain()
+
+    def waitData(self, timeout):
+        """Consumer: wait until there is data in the ring
+        """
+        if self.used() > 0:
+            return
+        self.data.wait(timeout)
+
+
+def attachRingBuffer(name, size, data, space):
+    """Map an existing ``RingBuffer`` by the name of its shared memory segment
+    """
+    ring = RingBuffer.__new__(RingBuffer)
+    ring.size = size
+    ring.shmem = shared_memory.SharedMemory(name = name)
+    ring.header = ring.shmem.buf[0:HEADER_SIZE].cast("Q")
+    ring.buf = ring.shmem.buf[HEADER_SIZE:HEADER_SIZE + size]
+    ring.data = data
+    ring.space = space
+    ring.unlinked = False
+    ring.owner_pid = None
+    return ring
+
+
+class RingDuplex:
+    """One endpoint of a shared memory ring buffer channel.  Looks like
+    ``multiprocessing.Pipe`` / ``Duplex``: has ``send``, ``recv``, ``poll`` and ``fileno``.
+
+    :param tx: RingBuffer for outgoing messages
+    :param rx: RingBuffer for incoming messages
+
+    ``fileno()`` returns a file descriptor that is readable when there are messages to be read,
+    so this can be used with ``select.select`` just like a ``multiprocessing.Pipe``.
+
+    Messages are framed as 8 bytes of length + pickled payload.  Sending and receiving are thread-safe.
+    Use ``getRingPipes`` to create the two endpoints.
+    """
+    wait_timeout = 0.05 # recheck interval if a wakeup signal was lost
+
+    def __init__(self, tx: RingBuffer, rx: RingBuffer):
+        self.tx = tx
+        self.rx = rx
+        self.send_lock = threading.Lock()
+        self.recv_lock = threading.Lock()
+
+    def __reduce__(self):
+        return (RingDuplex, (self.tx, self.rx))
+
+    def fileno(self):
+        return self.rx.data.fileno()
+
+    def unlink(self):
+        """Remove the names of the underlying shared memory segments from the system
+        """
+        self.tx.unlink()
+        self.rx.unlink()
+
+    def send_bytes(self, b):
+        """Blocking send of a bytes-like object
+        """
+        mv = memoryview(b).cast("B")
+        with self.send_lock:
+            if self.tx.writeFrame(mv): # fast path: frame fits in
+                return
+            # slow path: stream the frame through the ring in pieces
+            buffers = [len(mv).to_bytes(8, byteorder = "big"), mv]
+            while buffers:
+                n = self.tx.writev(buffers)
+                # drop what was written
+                while n > 0:
+                    if n >= len(buffers[0]):
+                        n -= len(buffers[0])
+                        buffers.pop(0)
+                    else:
+                        buffers[0] = memoryview(buffers[0])[n:]
+                        n = 0
+                if buffers:
+                    self.tx.waitSpace(self.wait_timeout)
+
+    def send(self, obj):
+        """Blocking send of a picklable object
+        """
+        self.send_bytes(pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL))
+
+    def readinto__(self, mv):
+        i = 0
+        while i < len(mv):
+            n = self.rx.readinto(mv[i:])
+            if n == 0:
+                self.rx.waitData(self.wait_timeout)
+            i += n
+
+    def recv_bytes(self):
+        """Blocking receive of a bytes-like object
+        """
+        with self.recv_lock:
+            b = self.rx.readFrame() # fast path: a complete frame is waiting
+            if b is not None:
+                return b
+            header = bytearray(8)
+            self.readinto__(memoryview(header))
+            buf = bytearray(int.from_bytes(header, byteorder = "big"))
+            self.readinto__(memoryview(buf))
+        return buf
+
+    def recv(self):
+        """Blocking receive of a picklable object
+        """
+        return pickle.loads(self.recv_bytes())
+
+    def poll(self, timeout = 0.0):
+        """Is there anything to read?
+
+        :param timeout: seconds to wait.  ``None`` waits forever.
+        """
+        if self.rx.used() > 0:
+            return True
+        if timeout is None or timeout > 0:
+            self.rx.data.wait(timeout)
+        return self.rx.used() > 0
+
+
+def getRingPipes(size = 1024*1024):
+    """Create a shared memory ring buffer channel.  Returns two ``RingDuplex`` endpoints, i.e.
+    similar to what you get from ``multiprocessing.Pipe()``.
+
+    :param size: ring buffer size in bytes (for each direction)
+
+    ::
+
+        A           B
+
+        w --ring--> r
+        r <-ring--- w
+    """
+    A_to_B = RingBuffer(size)
+    B_to_A = RingBuffer(size)
+    return RingDuplex(A_to_B, B_to_A), RingDuplex(B_to_A, A_to_B)
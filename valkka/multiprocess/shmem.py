@@ -0,0 +1,537 @@
+"""shmem.py : Shared memory helpers for passing numpy arrays between multiprocessing front- and backend
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    shmem.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   Shared memory helpers for passing numpy arrays between multiprocessing front- and backend
+"""
+import os
+import mmap
+import math
+import time
+import secrets
+import weakref
+import atexit
+import threading
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+try:
+    import numpy as np
+except ImportError: # numpy is optional
+    np = None
+
+
+SHM_DIR = "/dev/shm" # where posix shared memory lives in linux
+
+
+def mapShmem(name: str, size: int, unlink = False) -> mmap.mmap:
+    """Map an existing shared memory segment, created with ``multiprocessing.shared_memory``
+
+    :param name: name of the shared memory segment
+    :param size: size of the segment in bytes
+    :param unlink: remove the segment name from the system after mapping.  Doesn't touch the resource tracker: the process that
+                   created the segment unregisters it (see ``releaseHandles``)
+
+    The mapping stays alive as long as there are references to the returned ``mmap`` object
+    (say, a numpy array using it as a buffer)
+    """
+    path = os.path.join(SHM_DIR, name.lstrip("/"))
+    fd = os.open(path, os.O_RDWR)
+    try:
+        m = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    if unlink:
+        os.unlink(path)
+    return m
+
+
+def createShmem(name: str, size: int, track = True) -> mmap.mmap:
+    """Create and map a new shared memory segment
+
+    :param name: name of the shared memory segment.  Must not exist already
+    :param size: size of the segment in bytes
+    :param track: register the segment to the ``multiprocessing`` resource tracker, so that it is removed even if the python process crashes
+
+    Remove the segment with ``unlinkShmem``
+    """
+    path = os.path.join(SHM_DIR, name.lstrip("/"))
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        os.ftruncate(fd, size)
+        m = mmap.mmap(fd, size)
+    except:
+        os.close(fd)
+        os.unlink(path)
+        raise
+    os.close(fd)
+    if track:
+        resource_tracker.register("/" + name.lstrip("/"), "shared_memory")
+    return m
+
+
+def unlinkShmem(name: str, track = True):
+    """Remove a shared memory segment created with ``createShmem``
+    """
+    try:
+        os.unlink(os.path.join(SHM_DIR, name.lstrip("/")))
+    except FileNotFoundError:
+        pass
+    if track:
+        resource_tracker.unregister("/" + name.lstrip("/"), "shared_memory")
+
+
+class ShmemArrayHandle:
+    """A light-weight and picklable stand-in for a numpy array that has been copied into
+    a one-shot shared memory segment.
+
+    :param array: numpy array to be copied into shared memory
+
+    ``attach`` returns the array (a view to the shared memory, no copying) and removes
+    the shared memory segment name from the system: the memory is released once the array is garbage collected.
+
+    The segment is registered to the resource tracker of the creating process (started at the first handle), so it's removed even if
+    the receiving process crashes before attaching.  The receiver doesn't need a resource tracker of its own: the creator unregisters
+    the segments that have been attached with ``releaseHandles``.
+    """
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self.nbytes = array.nbytes
+        shmem = shared_memory.SharedMemory(create = True, size = max(self.nbytes, 1))
+        view = np.ndarray(self.shape, dtype = array.dtype, buffer = shmem.buf)
+        view[...] = array
+        del view
+        self.name = shmem.name
+        shmem.close() # close only at this side: the segment stays until attach
+        with handles_lock:
+            handles_in_flight.add(self.name)
+
+    def __str__(self):
+        return "<ShmemArrayHandle: %s %s %s>" % (self.name, self.shape, self.dtype)
+
+    def attach(self):
+        """Multiprocessing backend method: returns the numpy array.  Call only once.
+        """
+        m = mapShmem(self.name, max(self.nbytes, 1), unlink = True)
+        return np.ndarray(self.shape, dtype = np.dtype(self.dtype), buffer = m)
+
+
+handles_in_flight = set() # names of the ShmemArrayHandle segments created by this process and registered to its resource tracker
+handles_lock = threading.Lock()
+
+
+def releaseHandles():
+    """Unregister from the resource tracker the ``ShmemArrayHandle`` segments that have been attached (and so, unlinked) already.
+    Called when new handles are created and at exit
+    """
+    with handles_lock:
+        gone = [name for name in handles_in_flight if not os.path.exists(os.path.join(SHM_DIR, name.lstrip("/")))]
+        for name in gone:
+            handles_in_flight.discard(name)
+            resource_tracker.unregister("/" + name.lstrip("/"), "shared_memory")
+
+atexit.register(releaseHandles)
+
+
+def arraysToShmem(kwargs: dict, threshold: int) -> dict:
+    """Replace numpy arrays in kwargs with ``ShmemArrayHandle`` s
+
+    :param kwargs: dictionary, typically ``MessageObject.kwargs``
+    :param threshold: only arrays with at least this many bytes are moved into shared memory
+
+    Returns the original dictionary if there was nothing to replace
+    """
+    if np is None:
+        return kwargs
+    new = None
+    for key, value in kwargs.items():
+        if isinstance(value, np.ndarray) and value.nbytes >= threshold and not value.dtype.hasobject:
+            if new is None:
+                new = dict(kwargs)
+            new[key] = ShmemArrayHandle(value)
+    if new is None:
+        return kwargs
+    releaseHandles() # the ones sent previously
+    return new
+
+
+def arraysFromShmem(kwargs: dict) -> dict:
+    """Replace ``ShmemArrayHandle`` s in kwargs with numpy arrays using the shared memory
+
+    Returns the original dictionary if there was nothing to replace
+    """
+    for value in kwargs.values(): # this is called for every message, so check fast first
+        if value.__class__ is ShmemArrayHandle:
+            break
+    else:
+        return kwargs
+    new = dict(kwargs)
+    for key, value in kwargs.items():
+        if isinstance(value, ShmemArrayHandle):
+            new[key] = value.attach()
+    return new
+
+
+class SharedArray:
+    """A numpy array in a named shared memory segment, shared between the multiprocessing frontend and backend(s)
+
+    :param shape: shape of the array
+    :param dtype: numpy dtype of the array
+    :param name: name of the shared memory segment.  If ``None``, a unique name is generated
+    :param track: register the segment to the ``multiprocessing`` resource tracker, so that it is removed
+                  even if the python process crashes.  Use ``False`` if the segment should outlive the python process
+
+    Create in the frontend, say in the ``__init__`` of your ``MessageProcess``, and use ``self.shared.array`` both in the
+    frontend and in the backend:
+
+    ::
+
+        class MyProcess(MessageProcess):
+
+            def __init__(self, name):
+                super().__init__(name)
+                self.shared = SharedArray((100, 100), np.float32)
+
+            def c__readWrite(self):
+                self.shared.array[:,:] = 3.0
+
+    When pickled (say, sent to the backend in a ``MessageObject`` or with the "forkserver" start method), only the name, shape and dtype are
+    transferred and the shared memory is mapped right away when unpickled.  So, if you send a ``SharedArray`` in a ``MessageObject``, keep a
+    reference to it in the frontend until the backend has received the message: otherwise the segment might be removed before the backend maps it:
+
+    ::
+
+        self.shared = SharedArray((100, 100), np.float32) # not just a temporary variable
+        p.sendMessageToBack(MessageObject("useArray", shared = self.shared))
+
+    Only the python process that created the segment removes it: with ``unlink`` or at garbage collection.  Other processes never touch the
+    resource tracker, so there are no double unlinks or "leaked shared_memory" warnings.  Once unlinked, new processes can't attach anymore, but
+    the ones that already did keep their mapping.
+    """
+    def __init__(self, shape, dtype = "float64", name = None, track = True):
+        if isinstance(shape, int):
+            shape = (shape,)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.nbytes = np.dtype(dtype).itemsize * math.prod(self.shape)
+        self.track = track
+        if name is None:
+            name = "valkka_" + secrets.token_hex(8)
+        self.name = name.lstrip("/")
+        # create the segment ourselves, so that it is registered to the resource tracker only if asked
+        self.mmap = createShmem(self.name, max(self.nbytes, 1), track = self.track)
+        self.owner_pid = os.getpid() # a forked process inherits this object, but is not the owner
+        self.unlinked = False
+        self.array_ = None
+
+    def __str__(self):
+        return "<SharedArray: %s %s %s>" % (self.name, self.shape, self.dtype)
+
+    def __getstate__(self):
+        return {
+            "name": self.name,
+            "shape": self.shape,
+            "dtype": self.dtype,
+            "nbytes": self.nbytes,
+            "track": self.track
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mmap = None
+        self.owner_pid = None
+        self.unlinked = False
+        self.array_ = None
+        try:
+            self.mmap = mapShmem(self.name, max(self.nbytes, 1)) # map now, so that the owner may unlink the segment any time after this
+        except FileNotFoundError: # unlinked already: accessing buf or array raises
+            pass
+
+    def isOwner(self) -> bool:
+        """Was the segment created by this python process
+        """
+        return self.owner_pid == os.getpid()
+
+    @property
+    def buf(self) -> mmap.mmap:
+        """The shared memory.  Mapped again at access if ``close`` was called
+        """
+        if self.mmap is None:
+            self.mmap = mapShmem(self.name, max(self.nbytes, 1))
+        return self.mmap
+
+    @property
+    def array(self):
+        """The numpy array using the shared memory
+        """
+        if self.array_ is None:
+            self.array_ = np.ndarray(self.shape, dtype = np.dtype(self.dtype), buffer = self.buf)
+        return self.array_
+
+    def close(self):
+        """Drop the references to the shared memory in this python process.  The mapping is released once there are no
+        other references to ``array`` either.  ``array`` maps the memory again if accessed
+        """
+        self.array_ = None
+        self.mmap = None
+
+    def unlink(self):
+        """Remove the segment name from the system.  Does something only in the python process that created the segment and only once
+        """
+        if self.unlinked or not self.isOwner():
+            return
+        self.unlinked = True
+        unlinkShmem(self.name, track = self.track)
+
+    def __del__(self):
+        try:
+            self.unlink()
+        except Exception: # at interpreter shutdown, modules might be gone already
+            pass
+
+
+# states of a SlabPool block: one byte per block in the beginning of each segment
+SLAB_FREED = 0 # freed by any process, not yet reclaimed by the allocating process
+SLAB_IN_USE = 1
+SLAB_AVAILABLE = 2 # in the free list of the allocating process
+
+SLAB_ALIGN = 4096
+
+
+class SlabBlock:
+    """A block of ``SlabPool`` shared memory: just three integers, so cheap to send in a ``MessageObject``
+
+    :param segment: index of the segment (i.e. of the size class) in the pool
+    :param offset: offset of the block in the segment
+    :param length: number of bytes used in the block
+    """
+    __slots__ = ("segment", "offset", "length")
+
+    def __init__(self, segment: int, offset: int, length: int):
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def __str__(self):
+        return "<SlabBlock: %i %i %i>" % (self.segment, self.offset, self.length)
+
+    def __getstate__(self):
+        return (self.segment, self.offset, self.length)
+
+    def __setstate__(self, state):
+        self.segment, self.offset, self.length = state
+
+
+class SlabPool:
+    """Reusable blocks of shared memory, for passing variable-size frames between processes without creating a
+    shared memory segment for each one of them
+
+    :param size_classes: dictionary of block size (bytes) to number of blocks, say ``{65536: 64, 1024*1024: 16, 8*1024*1024: 4}``.
+                         Each size class is a shared memory segment of its own
+    :param name: prefix of the shared memory segment names.  If ``None``, a unique name is generated
+    :param track: register the segments to the ``multiprocessing`` resource tracker (see ``SharedArray``)
+
+    Blocks are allocated with ``alloc`` in the process that created the pool (typically the frontend) and they can be freed
+    in any process (typically the backend), after which the allocating process reuses them.  An allocation is a pop from
+    a free list and a free is a write of one byte into shared memory: no system calls, no page faults and the memory used
+    is fixed.
+
+    ::
+
+        pool = SlabPool({65536: 64, 1024*1024: 16}) # in the frontend, before starting the multiprocesses
+        ...
+        block = pool.write(frame_bytes) # frontend
+        self.sendMessageToBack(MessageObject("analyze", block=block))
+        ...
+        def c__analyze(self, block=None): # backend
+            frame = self.pool.array(block, np.uint8) # the block is freed once frame is garbage collected
+
+    Like ``SharedArray``, the pool is pickled with just the segment names and sizes, and only the process that created
+    it unlinks the segments.
+    """
+    def __init__(self, size_classes: dict, name = None, track = True):
+        if name is None:
+            name = "valkka_slab_" + secrets.token_hex(6)
+        self.name = name.lstrip("/")
+        self.track = track
+        self.sizes = sorted(size_classes)
+        self.counts = [size_classes[size] for size in self.sizes]
+        self.names = ["%s_%i" % (self.name, i) for i in range(len(self.sizes))]
+        # data of each segment starts after the block state bytes
+        self.data_start = [(count + SLAB_ALIGN - 1) // SLAB_ALIGN * SLAB_ALIGN for count in self.counts]
+        self.mmaps = []
+        try:
+            for segment_name, size, count, start in zip(self.names, self.sizes, self.counts, self.data_start):
+                m = createShmem(segment_name, start + size * count, track = self.track)
+                m[0:count] = bytes([SLAB_AVAILABLE]) * count
+                self.mmaps.append(m)
+        except:
+            for segment_name in self.names[:len(self.mmaps)]:
+                unlinkShmem(segment_name, track = self.track)
+            raise
+        self.owner_pid = os.getpid()
+        self.unlinked = False
+        self.init__()
+        for i, count in enumerate(self.counts):
+            self.free_list[i].extend(range(count))
+
+    def init__(self):
+        self.free_list = [deque() for size in self.sizes] # block indexes, for each size class
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "<SlabPool: %s %s>" % (self.name, dict(zip(self.sizes, self.counts)))
+
+    def __getstate__(self):
+        return {
+            "name": self.name,
+            "track": self.track,
+            "sizes": self.sizes,
+            "counts": self.counts,
+            "names": self.names,
+            "data_start": self.data_start
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mmaps = [None] * len(self.sizes)
+        self.owner_pid = None
+        self.unlinked = False
+        self.init__()
+
+    def isOwner(self) -> bool:
+        """Was the pool created by this python process.  Only the owner can allocate blocks
+        """
+        return self.owner_pid == os.getpid()
+
+    def segment__(self, i) -> mmap.mmap:
+        m = self.mmaps[i]
+        if m is None:
+            m = mapShmem(self.names[i], self.data_start[i] + self.sizes[i] * self.counts[i])
+            self.mmaps[i] = m
+        return m
+
+    def reclaim__(self, i):
+        """Move blocks freed by any process into the free list of size class i.  Call with the lock held
+        """
+        m = self.mmaps[i]
+        free_list = self.free_list[i]
+        count = self.counts[i]
+        j = m.find(b"\x00", 0, count) # C-speed scan
+        while j >= 0:
+            m[j] = SLAB_AVAILABLE
+            free_list.append(j)
+            j = m.find(b"\x00", j + 1, count)
+
+    def alloc(self, nbytes: int, timeout = 0.0):
+        """Allocate a block of at least ``nbytes`` bytes from the smallest size class that has free blocks.
+        Returns a ``SlabBlock``, or ``None`` if there were no free blocks within ``timeout`` seconds
+
+        Call only in the process that created the pool
+        """
+        if self.owner_pid != os.getpid():
+            raise RuntimeError("SlabPool: alloc can be called only in the process that created the pool")
+        if nbytes > self.sizes[-1]:
+            raise ValueError("SlabPool: %i bytes is larger than the largest block size %i" % (nbytes, self.sizes[-1]))
+        deadline = None
+        while True:
+            with self.lock:
+                for i, size in enumerate(self.sizes):
+                    if size < nbytes:
+                        continue
+                    free_list = self.free_list[i]
+                    if not free_list:
+                        self.reclaim__(i)
+                        if not free_list:
+                            continue
+                    j = free_list.pop() # LIFO: the most recently used block is the most likely to be in cache
+                    self.mmaps[i][j] = SLAB_IN_USE
+                    return SlabBlock(i, self.data_start[i] + j * size, nbytes)
+            if timeout is not None and timeout <= 0:
+                return None
+            if deadline is None and timeout is not None:
+                deadline = time.monotonic() + timeout
+            elif deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(0.0005)
+
+    def free(self, block: SlabBlock):
+        """Return a block to the pool.  Can be called in any process
+        """
+        self.segment__(block.segment)[(block.offset - self.data_start[block.segment]) // self.sizes[block.segment]] = SLAB_FREED
+
+    def view(self, block: SlabBlock) -> memoryview:
+        """A memoryview to the used bytes of a block
+        """
+        return memoryview(self.segment__(block.segment))[block.offset:block.offset + block.length]
+
+    def write(self, data, timeout = 0.0):
+        """Allocate a block and copy data (bytes, bytearray, memoryview or a numpy array) into it.
+        Returns a ``SlabBlock``, or ``None`` if there were no free blocks within ``timeout`` seconds
+        """
+        data = memoryview(data).cast("B")
+        block = self.alloc(data.nbytes, timeout = timeout)
+        if block is not None:
+            self.mmaps[block.segment][block.offset:block.offset + block.length] = data
+        return block
+
+    def array(self, block: SlabBlock, dtype = "uint8", shape = None, free = True):
+        """A numpy array using the memory of a block (no copying)
+
+        :param block: a ``SlabBlock``
+        :param dtype: numpy dtype of the array
+        :param shape: shape of the array.  Default: one-dimensional
+        :param free: free the block once the array is garbage collected
+        """
+        dtype = np.dtype(dtype)
+        array = np.frombuffer(self.segment__(block.segment), dtype = dtype, count = block.length // dtype.itemsize, offset = block.offset)
+        if free:
+            # all views derived from this array keep a reference to it, so attach the finalizer here
+            weakref.finalize(array, self.free, block)
+        if shape is not None:
+            array = array.reshape(shape)
+        return array
+
+    def getStats(self) -> dict:
+        """Returns a dictionary of block size to a dictionary with keys ``blocks`` (total) and ``in_use``.  Counts the blocks in this
+        python process: call in the allocating process to get the real picture
+        """
+        stats = {}
+        for i, size in enumerate(self.sizes):
+            m = self.segment__(i)
+            stats[size] = {"blocks": self.counts[i], "in_use": m[0:self.counts[i]].count(SLAB_IN_USE)}
+        return stats
+
+    def unlink(self):
+        """Remove the segments from the system.  Does something only in the python process that created the pool and only once
+        """
+        if self.unlinked or not self.isOwner():
+            return
+        self.unlinked = True
+        for segment_name in self.names:
+            unlinkShmem(segment_name, track = self.track)
+
+    def __del__(self):
+        try:
+            self.unlink()
+        except Exception: # at interpreter shutdown, modules might be gone already
+            pass
@@ -1,32 +1,188 @@
+import os
+import time
+import select
+import asyncio
 import traceback
+import threading
+from collections import deque
 from multiprocessing import Event
+from multiprocessing.reduction import DupFd
 # from valkka import core # nopes
 
 class NotEnoughEvents(BaseException):
     pass
 
+class SyncTimeout(TimeoutError):
+    """Raised by ``SyncIndex`` when the event was not set in time
+    """
+    pass
+
+class FdEvent:
+    """An event like ``multiprocessing.Event``, but implemented with a file descriptor (linux ``eventfd``,
+    or a pipe if eventfd is not available), so it can be used with ``select``, selectors (epoll) and asyncio.
+
+    Must be created before forking.  The event is set as long as the file descriptor is readable.
+
+    ::
+
+        eg = EventGroup(100, FdEvent) # an EventGroup of FdEvents
+    """
+    def __init__(self):
+        if hasattr(os, "eventfd"):
+            self.read_fd = os.eventfd(0, os.EFD_NONBLOCK)
+            self.write_fd = self.read_fd
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+            os.set_blocking(self.write_fd, False)
+
+    def __reduce__(self):
+        # when the process is started with a fork server (see zygote.py), the file descriptors are sent to it
+        if self.write_fd == self.read_fd:
+            return (rebuildFdEvent, (DupFd(self.read_fd), None))
+        return (rebuildFdEvent, (DupFd(self.read_fd), DupFd(self.write_fd)))
+
+    def __del__(self):
+        try:
+            os.close(self.read_fd)
+            if self.write_fd != self.read_fd:
+                os.close(self.write_fd)
+        except (OSError, AttributeError):
+            pass
+
+    def fileno(self):
+        """File descriptor that is readable while the event is set
+        """
+        return self.read_fd
+
+    def set(self):
+        try:
+            if self.read_fd == self.write_fd:
+                os.eventfd_write(self.write_fd, 1)
+            else:
+                os.write(self.write_fd, b"x")
+        except BlockingIOError: # set already many times over
+            pass
+
+    def clear(self):
+        try:
+            if self.read_fd == self.write_fd:
+                os.eventfd_read(self.read_fd)
+            else:
+                while os.read(self.read_fd, 4096):
+                    pass
+        except BlockingIOError: # was not set
+            pass
+
+    def is_set(self) -> bool:
+        return self.wait(0)
+
+    def wait(self, timeout = None) -> bool:
+        """Wait until the event is set.  Returns ``True`` if it is set, ``False`` if timed out
+        """
+        poller = select.poll()
+        poller.register(self.read_fd, select.POLLIN)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return len(poller.poll(None if deadline is None else max(deadline - time.monotonic(), 0)*1000)) > 0
+            except InterruptedError:
+                pass
+
+    async def waitAsync(self):
+        """Wait in asyncio until the event is set
+        """
+        if self.is_set():
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def callback():
+            if not future.done():
+                future.set_result(None)
+        loop.add_reader(self.read_fd, callback)
+        try:
+            await future
+        finally:
+            loop.remove_reader(self.read_fd)
+
+
+def rebuildFdEvent(read_df, write_df):
+    event = FdEvent.__new__(FdEvent)
+    event.read_fd = read_df.detach()
+    event.write_fd = event.read_fd if write_df is None else write_df.detach()
+    return event
+
+
+def waitEvents(events, timeout = None) -> list:
+    """Wait until all the events are set, with a single ``poll`` call per wakeup instead of one ``wait`` per event
+
+    :param events: list of ``FdEvent`` s (or any objects having ``fileno``, readable when set)
+    :param timeout: seconds.  ``None`` waits forever
+
+    Returns the list of events that are set: shorter than ``events`` if timed out
+    """
+    poller = select.poll()
+    waiting = {}
+    for event in events:
+        waiting[event.fileno()] = event
+        poller.register(event.fileno(), select.POLLIN)
+    done = []
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while waiting:
+        try:
+            ready = poller.poll(None if deadline is None else max(deadline - time.monotonic(), 0)*1000)
+        except InterruptedError:
+            continue
+        if not ready:
+            break # timeout
+        for fd, mask in ready:
+            poller.unregister(fd)
+            done.append(waiting.pop(fd))
+    return done
+
+
 class EventGroup:
     """Creates a group of multiprocessing events
 
     :param n: number of events to be instantiated and cached
     :param event_class: a multiprocessing event class that has ``set`` and ``clear`` methods.
-                        default: python ``multiprocessing.Event``.  Can also be ``EventFd`` from libValkka.
-    
+                        default: python ``multiprocessing.Event``.  Can also be ``FdEvent`` (selectable) or ``EventFd`` from libValkka.
+
+    Reserving and releasing events are O(1) and thread-safe.
     """
     def __init__(self, n = 10, event_class = Event):
         self.events = [] # list of cached events: immutable
-        self.index = [] # list of indexes of available events: mutable
+        self.index = deque() # indexes of available events: mutable
+        self.reserved = [False] * n
+        self.quarantined = set() # indexes of timed-out events: the backend might still set them
+        self.index_by_id = {} # id(event) => index
+        self.lock = threading.Lock()
         for i in range(n):
-            self.events.append(event_class()) 
-            self.index.append(i) 
+            event = event_class()
+            self.events.append(event)
+            self.index.append(i)
+            self.index_by_id[id(event)] = i
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("lock")
+        state.pop("index_by_id") # ids are not the same after unpickling
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.index_by_id = {id(event): i for i, event in enumerate(self.events)}
 
     def __str__(self):
         st = "<EventGroup: "
-        for i in range(len(self.events)):
-            if i in self.index:
-                st += "f"+str(i)+" "
-            else:
+        for i, reserved in enumerate(self.reserved):
+            if i in self.quarantined:
+                st += "Q"+str(i)+" "
+            elif reserved:
                 st += "R"+str(i)+" "
+            else:
+                st += "f"+str(i)+" "
         st += ">"
         return st
 
@@ -43,10 +199,12 @@ class EventGroup:
 
         Use typically at process frontend / python main process
         """
-        try:
-            index = self.index.pop(0)
-        except IndexError as e:
-            raise NotEnoughEvents
+        with self.lock:
+            try:
+                index = self.index.popleft()
+            except IndexError as e:
+                raise NotEnoughEvents
+            self.reserved[index] = True
         event = self.events[index]
         # event.clear() # clear event before using it
         """..woops: simply calling clear before calling set
@@ -64,10 +222,10 @@ class EventGroup:
         :param event: event to be released / returned
         """
         try:
-            index = self.events.index(event)
-        except ValueError: # trying to return an event that's not in this EventGroup
+            index = self.index_by_id[id(event)]
+        except KeyError: # trying to return an event that's not in this EventGroup
             raise ValueError("event not in this Eventgroup")
-        self.index.append(index)
+        self.release_ind(index)
 
     def release_ind(self, index: int):
         """Release an EventFd sync primitive, based on the index.
@@ -75,7 +233,32 @@ class EventGroup:
 
         :param index: event's index
         """
-        self.index.append(index)
+        with self.lock:
+            if not self.reserved[index]: # released already
+                return
+            self.reserved[index] = False
+            self.quarantined.discard(index)
+            self.index.append(index)
+
+    def quarantine(self, index: int):
+        """Keep a reserved event out of use: say, the backend did not set it in time but might still do so later.
+        Release quarantined events with ``releaseQuarantined`` when it's safe (say, after restarting the backend)
+        """
+        with self.lock:
+            if self.reserved[index]:
+                self.quarantined.add(index)
+
+    def releaseQuarantined(self) -> int:
+        """Release all quarantined events.  Returns their number
+        """
+        with self.lock:
+            indexes = list(self.quarantined)
+            self.quarantined.clear()
+        for index in indexes:
+            self.events[index].set() # see reserve
+            self.events[index].clear()
+            self.release_ind(index)
+        return len(indexes)
 
     def fromIndex(self, i):
         """Get an event, based on the event index.
@@ -86,30 +269,70 @@ class EventGroup:
     def asIndex(self, event):
         """Return index corresponding to an event
         """
-        return self.events.index(event)
+        try:
+            return self.index_by_id[id(event)]
+        except KeyError:
+            raise ValueError("event not in this Eventgroup")
 
 
 class SyncIndex:
     """A context manager for synchronizing between multiprocessing front- and backend.
 
     :param event_group: an EventGroup instance
+    :param timeout: seconds to wait for the event.  Default: ``None`` (wait forever)
+    :param quarantine: if the wait times out, quarantine the event (see ``EventGroup.quarantine``) instead of releasing it.  Default: ``True``
+
+    Wait's and releases an event at context manager exit.  If the event is not set in ``timeout`` seconds, raises ``SyncTimeout``.
 
-    Wait's and releases an event at context manager exit
+    Works also in asyncio with ``async with``: the event is then awaited without blocking the event loop.  This is
+    efficient with ``FdEvent`` s (file descriptor is listened by the event loop), other events are waited in a thread.
     """
-    def __init__(self, event_group: EventGroup):
+    def __init__(self, event_group: EventGroup, timeout = None, quarantine = True):
         self.eg = event_group
+        self.timeout = timeout
+        self.quarantine = quarantine
         self.event = None
+        self.index = None
 
     def __enter__(self):
-        i, self.event = self.eg.reserve()
-        return i
+        self.index, self.event = self.eg.reserve()
+        return self.index
 
     def __exit__(self, type, value, tb):
         if tb:
             print("SyncIndex failed with:")
             traceback.print_tb(tb)
-        self.event.wait() # wait until the event has been set
+        if self.timeout is None:
+            self.event.wait() # wait until the event has been set
+        elif not self.event.wait(self.timeout):
+            self.timedOut__()
         self.eg.release(self.event) # recycle the event
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, type, value, tb):
+        if tb:
+            print("SyncIndex failed with:")
+            traceback.print_tb(tb)
+        if isinstance(self.event, FdEvent):
+            waiter = self.event.waitAsync()
+        else:
+            waiter = asyncio.get_running_loop().run_in_executor(None, self.event.wait)
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            if not isinstance(self.event, FdEvent):
+                self.event.set() # terminate the thread
+            self.timedOut__()
+        self.eg.release(self.event)
+
+    def timedOut__(self):
+        if self.quarantine:
+            self.eg.quarantine(self.index)
+        else:
+            self.eg.release(self.event)
+        raise SyncTimeout("event %i was not set in %s s" % (self.index, self.timeout))
     
 
 
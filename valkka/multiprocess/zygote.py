@@ -0,0 +1,74 @@
+"""zygote.py : Start multiprocesses from a warm fork server that has preloaded heavy modules
+
+Copyright 2017-2023 Sampsa Riikonen
+
+Authors: Sampsa Riikonen (sampsa.riikonen@iki.fi)
+
+This particular file, referred below as "Software", is licensed under the MIT LICENSE:
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom
+the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+@file    zygote.py
+@author  Sampsa Riikonen
+@date    2023
+@version 1.6.1
+
+@brief   Start multiprocesses from a warm fork server that has preloaded heavy modules
+"""
+import multiprocessing
+from multiprocessing import forkserver
+from valkka.multiprocess.base import MessageProcess
+
+
+class Zygote:
+    """A fork server (aka zygote) that imports a set of modules once.  ``MessageProcess`` backends
+    are then forked from that warm state, so they don't need to import the modules themselves.
+
+    :param preload: list of module names to import in the zygote, say ``["numpy", "torch", "mypackage.detector"]``
+
+    The zygote is a fresh single-threaded python process, so forking from it is safe even when
+    your main process is multi-threaded.  Use it like this:
+
+    ::
+
+        zygote = Zygote(["numpy", "mypackage.detector"]) # do this first thing in your main process
+        p = MyProcess(name = "my-process")
+        zygote.start(p) # instead of p.start()
+        ...
+        p.stop()
+
+    Some things to note:
+
+    - There is only one fork server per python process: create the zygote before any other multiprocess
+      is started with it and don't change the preloaded modules afterwards
+    - The ``MessageProcess`` instance is pickled and sent to the zygote, so its class must be importable
+      (i.e. not defined inside a function) and its attributes picklable
+    - multiprocessing synchronization primitives must come from the same context, say ``EventGroup(10, zygote.context.Event)``
+    - Whatever a preloaded module does at import time (say, loading a neural net model) is inherited by all
+      multiprocesses started from the zygote
+    - Like with the "spawn" start method, your main script is run again (as ``__mp_main__``) in every multiprocess started
+      from the zygote: keep its top-level code behind ``if __name__ == "__main__":``
+    """
+    def __init__(self, preload = []):
+        self.preload = ["valkka.multiprocess"] + list(preload)
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(self.preload)
+        # start now: the modules are imported in the background while the main process continues
+        forkserver.ensure_running()
+
+    def __str__(self):
+        return "<Zygote: %s>" % (self.preload)
+
+    def start(self, process: MessageProcess):
+        """Start a multiprocess by forking it from the zygote.  Use instead of ``process.start()``
+        """
+        process._Popen = self.context.Process._Popen
+        process.start()